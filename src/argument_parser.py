@@ -1,8 +1,24 @@
 import argparse
+import os
 import sys
 
 
-def get_args():
+def get_default_cache_dir():
+    if os.name == 'nt' and 'LOCALAPPDATA' in os.environ:
+        base = os.environ['LOCALAPPDATA']
+    else:
+        base = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'http-xiso-wrapper')
+
+
+parsed_args = {}
+
+
+def get_arg_parser():
+    """
+    Returns the parser of the server arguments (tools can add their own)
+    """
     parser = argparse.ArgumentParser()
     parser.add_argument("--dvd_path", help="the file to open with xemu")
     parser.add_argument("--xemu_path", help="path of the xemu executable",
@@ -12,4 +28,60 @@ def get_args():
                         action="store_true")
     parser.add_argument("--port", help="server port (default 8000)", type=int, default=8000)
     parser.add_argument("--verbose", help="increase output verbosity", action="store_true")
-    return parser.parse_args()
+    parser.add_argument("--cache_dir", help="directory of the persistent caches",
+                        default=get_default_cache_dir())
+    parser.add_argument("--no_cache", help="disable the persistent caches",
+                        action="store_true")
+    parser.add_argument("--chd_cache_size", help="memory for decoded CHD hunks in MiB (default 64)",
+                        type=int, default=64)
+    parser.add_argument("--chd_readahead", help="CHD hunks to decode in advance on sequential reads (default 8, 0 to disable)",
+                        type=int, default=8)
+    parser.add_argument("--chd_workers", help="CHD hunks decoded in parallel for large reads (default 4, 1 to disable)",
+                        type=int, default=4)
+    parser.add_argument("--chd_pool", help="run the parallel CHD decoding on threads or processes (default thread)",
+                        choices=["thread", "process"], default="thread")
+    parser.add_argument("--zip_checkpoint_spacing", help="output MiB between the seek checkpoints of compressed zip members (default 4)",
+                        type=int, default=4)
+    parser.add_argument("--zip_cache_size", help="memory for decompressed zip data in MiB (default 64)",
+                        type=int, default=64)
+    parser.add_argument("--zip_spill", help="spill the decompressed data of zip members larger than this (in MiB) to a temporary file (default 0, disabled)",
+                        type=int, default=0)
+    parser.add_argument("--fd_pool_size", help="maximum number of loose files kept open (default 0, automatic based on the open files limit)",
+                        type=int, default=0)
+    parser.add_argument("--mmap", help="read XISO images and unpacked files through memory maps",
+                        action="store_true")
+    parser.add_argument("--engine", help="server implementation (default threaded)",
+                        choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--async_workers", help="threads reading the images with the asyncio engine (default 8)",
+                        type=int, default=8)
+    parser.add_argument("--idle_timeout", help="seconds before closing an idle connection (default 60)",
+                        type=int, default=60)
+    parser.add_argument("--readahead", help="prefetch the data following sequential requests (default auto, only for zip and CHD files)",
+                        choices=["auto", "on", "off"], default="auto")
+    parser.add_argument("--readahead_cache_size", help="memory for the prefetched data of each image in MiB (default 32)",
+                        type=int, default=32)
+    parser.add_argument("--block_cache_size", help="memory for the most read blocks of the images in MiB, shared by all the images (default 64, 0 disables it)",
+                        type=int, default=64)
+    parser.add_argument("--max_images", help="number of images kept parsed, the least recently used are closed (default 16)",
+                        type=int, default=16)
+    parser.add_argument("--library", help="serve the images in this directory (and its subdirectories), parsed in advance")
+    parser.add_argument("--library_workers", help="threads parsing the images of the library (default 2)",
+                        type=int, default=2)
+    parser.add_argument("--trace_file", help="record the served ranges into this file (see trace_replay.py)")
+    return parser
+
+
+def get_args():
+    """
+    Returns the arguments (parsed from the command line the first time)
+    """
+    if "default" not in parsed_args:
+        parsed_args["default"] = get_arg_parser().parse_args()
+    return parsed_args["default"]
+
+
+def set_args(args):
+    """
+    Sets the arguments returned by get_args (for tools parsing their own)
+    """
+    parsed_args["default"] = args
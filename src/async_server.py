@@ -0,0 +1,322 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+import os
+import posixpath
+import sys
+import time
+import urllib.parse
+import uuid
+
+from image_parsers import stage_timer
+from image_parsers.image_parser import FileExtent, STREAM_CHUNK_SIZE
+from metrics import RequestMetrics
+from xiso_request_handler import (finish_request, get_image_name,
+                                  get_internal_page, get_response_length,
+                                  get_response_parts, parse_byte_range,
+                                  parser_cache, resolve_byte_ranges)
+
+
+MAX_HEADERS = 100
+SERVER_VERSION = "XisoAsyncHTTP/1.0"
+
+
+def translate_path(path):
+    """
+    Translates a request path to a local path (from the working directory),
+    like SimpleHTTPRequestHandler.translate_path
+    """
+    path = path.split('?', 1)[0]
+    path = path.split('#', 1)[0]
+    try:
+        path = urllib.parse.unquote(path, errors='surrogatepass')
+    except UnicodeDecodeError:
+        path = urllib.parse.unquote(path)
+    path = posixpath.normpath(path)
+    words = filter(None, path.split('/'))
+    path = os.getcwd()
+    for word in words:
+        if os.path.dirname(word) or word in (os.curdir, os.pardir):
+            # ignore components that are not a simple file/directory name
+            continue
+        path = os.path.join(path, word)
+    return path
+
+
+def take_segments(segments, times):
+    """
+    Returns the next segments of the iterator, up to STREAM_CHUNK_SIZE bytes
+    or a FileExtent (so small segments don't need a pool round trip each).
+    The time of the stages is added to times.
+    """
+    res = []
+    size = 0
+    stage_timer.start(times)
+    try:
+        for segment in segments:
+            res.append(segment)
+            if isinstance(segment, FileExtent):
+                break
+            size += len(segment)
+            if size >= STREAM_CHUNK_SIZE:
+                break
+    finally:
+        stage_timer.stop()
+    return res
+
+
+def read_extent(extent, times):
+    t = time.perf_counter()
+    data = extent.read()
+    times["read"] += time.perf_counter() - t
+    return data
+
+
+class BadRequest(Exception):
+    pass
+
+
+class AsyncXisoServer:
+    """
+    HTTP/1.1 server on asyncio, answering like XisoRequestHandler
+    (HEAD and GET, with byte ranges), without a thread per connection.
+    Connections are kept alive until idle for idle_timeout seconds.
+    The parser calls run on a pool of a fixed number of threads, and the
+    bodies are written in chunks, waiting for the socket buffer to drain
+    (so slow clients don't make the data pile up in memory).
+    """
+
+    def __init__(self, workers, idle_timeout):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.idle_timeout = idle_timeout
+
+    async def run_blocking(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print("Serving HTTP on %s port %d (http://%s:%d/) ..." % (host, port,
+                                                                  host, port))
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        client = peer[0] if peer else '-'
+        try:
+            keep_alive = True
+            while keep_alive:
+                keep_alive = await self.handle_request(reader, writer, client)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def read_request(self, reader):
+        """
+        Returns the method, the path, the version and the headers (with
+        lowercase names) of the next request, None if the client closed
+        the connection
+        """
+        line = await asyncio.wait_for(reader.readline(),
+                                      self.idle_timeout)
+        if not line:
+            return None
+        words = line.decode('iso-8859-1').rstrip('\r\n').split()
+        if len(words) != 3 or not words[2].startswith('HTTP/'):
+            raise BadRequest(line)
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(),
+                                          self.idle_timeout)
+            line = line.decode('iso-8859-1').rstrip('\r\n')
+            if line == '':
+                break
+            if len(headers) >= MAX_HEADERS or ':' not in line:
+                raise BadRequest(line)
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > 0:
+            # requests bodies are not used, skip them
+            await reader.readexactly(length)
+        return words[0], words[1], words[2], headers
+
+    def get_keep_alive(self, version, headers):
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    async def handle_request(self, reader, writer, client):
+        try:
+            request = await self.read_request(reader)
+        except (BadRequest, ValueError):
+            await self.send_error(writer, 'GET', 400, False)
+            return False
+        if request is None:
+            return False
+        method, target, version, headers = request
+        request_line = "%s %s %s" % (method, target, version)
+        keep_alive = self.get_keep_alive(version, headers)
+        code, size = await self.respond(writer, method, target, headers,
+                                        keep_alive)
+        self.log_request(client, request_line, code, size)
+        return keep_alive
+
+    async def respond(self, writer, method, target, headers, keep_alive):
+        """
+        Sends the response, returns the status code and the body size
+        """
+        if method not in ('GET', 'HEAD'):
+            return await self.send_error(writer, method, 501, keep_alive)
+        page = get_internal_page(target)
+        if page is not None:
+            content_type, body = page
+            self.write_head(writer, 200, {
+                'Content-type': content_type,
+                'Content-Length': str(len(body)),
+                'Cache-Control': 'no-cache'
+            }, keep_alive)
+            if method == 'GET':
+                writer.write(body)
+            await writer.drain()
+            return 200, len(body)
+        request = RequestMetrics(get_image_name(target))
+        path = translate_path(target)
+        parser = await self.run_blocking(parser_cache.acquire, path)
+        try:
+            return await self.respond_with_parser(writer, method, parser,
+                                                  headers, keep_alive,
+                                                  request)
+        finally:
+            finish_request(request)
+            if parser is not None:
+                parser_cache.release(parser)
+
+    async def respond_with_parser(self, writer, method, parser, headers,
+                                  keep_alive, request):
+        ranges = None
+        if 'range' in headers:
+            try:
+                ranges = parse_byte_range(headers['range'])
+            except ValueError:
+                return await self.send_error(writer, method, 400, keep_alive)
+        if parser is None:
+            return await self.send_error(writer, method, 404, keep_alive)
+
+        await self.run_blocking(parser.f.open)
+        file_len = parser.get_size()
+        response_headers = {
+            'Content-type': 'application/octet-stream',
+            'Last-Modified': formatdate(time.time(), usegmt=True)
+        }
+        if ranges is not None:
+            ranges = resolve_byte_ranges(ranges, file_len)
+            if len(ranges) == 0:
+                return await self.send_error(writer, method, 416, keep_alive)
+            code = 206
+            boundary = uuid.uuid4().hex
+            parts, end = get_response_parts(ranges, file_len, boundary)
+            if len(ranges) == 1:
+                first, last = ranges[0]
+                response_headers['Content-Range'] = 'bytes %s-%s/%s' % (
+                    first, last, file_len)
+            else:
+                response_headers['Content-type'] = \
+                    'multipart/byteranges; boundary=' + boundary
+        else:
+            code = 200
+            parts, end = [(b'', 0, file_len - 1)], b''
+        length = get_response_length(parts, end)
+        if method == 'GET':
+            # HEAD responses have no body, they're not served ranges
+            request.ranges = [(first, last) for _, first, last in parts]
+        response_headers['Content-Length'] = str(length)
+        self.write_head(writer, code, response_headers, keep_alive)
+        if method == 'GET':
+            await self.send_body(writer, parser, parts, end, request)
+        else:
+            await writer.drain()
+        return code, length
+
+    async def send_body(self, writer, parser, parts, end, request):
+        for header, first, last in parts:
+            writer.write(header)
+            segments = parser.iter_segments_in_range(first, last + 1)
+            while True:
+                # the segments are read on the pool when they're needed
+                batch = await self.run_blocking(take_segments, segments,
+                                                request.times)
+                if len(batch) == 0:
+                    break
+                for segment in batch:
+                    await self.send_segment(writer, segment, request)
+        writer.write(end)
+        await writer.drain()
+
+    async def send_segment(self, writer, segment, request):
+        if isinstance(segment, FileExtent):
+            for piece in segment.split(STREAM_CHUNK_SIZE):
+                data = await self.run_blocking(read_extent, piece,
+                                               request.times)
+                await self.write_data(writer, data, request)
+            return
+        # views of mapped files can be large, and the transport copies what
+        # it can't send right away
+        view = memoryview(segment)
+        for i in range(0, len(view), STREAM_CHUNK_SIZE):
+            await self.write_data(writer, view[i:i + STREAM_CHUNK_SIZE],
+                                  request)
+
+    async def write_data(self, writer, data, request):
+        t = time.perf_counter()
+        writer.write(data)
+        await writer.drain()
+        request.times["write"] += time.perf_counter() - t
+        request.sent += len(data)
+
+    async def send_error(self, writer, method, code, keep_alive):
+        status = HTTPStatus(code)
+        body = ("%d %s\n" % (code, status.phrase)).encode()
+        self.write_head(writer, code, {
+            'Content-Type': 'text/plain',
+            'Content-Length': str(len(body))
+        }, keep_alive)
+        if method != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+        return code, len(body)
+
+    def write_head(self, writer, code, headers, keep_alive):
+        lines = ["HTTP/1.1 %d %s" % (code, HTTPStatus(code).phrase),
+                 "Server: " + SERVER_VERSION,
+                 "Date: " + formatdate(time.time(), usegmt=True)]
+        for name, value in headers.items():
+            lines.append(name + ": " + value)
+        lines.append("Accept-Ranges: bytes")
+        lines.append("Connection: " + ("keep-alive" if keep_alive
+                                       else "close"))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+    def log_request(self, client, request_line, code, size):
+        # same format as BaseHTTPRequestHandler
+        date = time.strftime("%d/%b/%Y %H:%M:%S")
+        sys.stderr.write('%s - - [%s] "%s" %s %s\n' % (client, date,
+                                                       request_line, code,
+                                                       size))
+
+
+def serve(host, port, workers, idle_timeout):
+    server = AsyncXisoServer(workers, idle_timeout)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        print("\nKeyboard interrupt received, exiting.")
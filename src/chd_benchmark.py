@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Measures the throughput of large CHD reads, decoding the hunks one at a
+time on the reading thread and in parallel on the worker pool.
+"""
+
+import argparse
+import time
+
+from image_parsers.file_readers.chd_reader import ChdReader, CHD_ENABLED
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="the CHD file to read")
+    parser.add_argument("--read_size", help="size of each read in MiB (default 8)",
+                        type=int, default=8)
+    parser.add_argument("--total", help="MiB to read for each run (default 256)",
+                        type=int, default=256)
+    parser.add_argument("--workers", help="parallel decoding workers (default 4)",
+                        type=int, default=4)
+    parser.add_argument("--pool", help="pool type for the parallel run (default thread)",
+                        choices=["thread", "process"], default="thread")
+    return parser.parse_args()
+
+
+def measure(path, workers, pool, read_size, total):
+    # no cache and no readahead, so that every read decodes its hunks
+    reader_args = argparse.Namespace(chd_cache_size=0, chd_readahead=0,
+                                     chd_workers=workers, chd_pool=pool)
+    f = ChdReader(path, reader_args)
+    f.open()
+    total = min(total, f.get_size())
+    buf = memoryview(bytearray(read_size))
+    start = time.perf_counter()
+    offset = 0
+    while offset < total:
+        n = min(read_size, total - offset)
+        f.readinto_at(offset, buf[:n])
+        offset += n
+    elapsed = time.perf_counter() - start
+    return total / elapsed / (1024 * 1024)
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if not CHD_ENABLED:
+        print("chd-rs-py not found, CHD support disabled")
+    else:
+        read_size = args.read_size * 1024 * 1024
+        total = args.total * 1024 * 1024
+        single = measure(args.path, 1, "thread", read_size, total)
+        print("single-threaded: %.1f MiB/s" % single)
+        parallel = measure(args.path, args.workers, args.pool, read_size,
+                           total)
+        print("%d %s workers: %.1f MiB/s (%.2fx)" % (args.workers, args.pool,
+                                                     parallel,
+                                                     parallel / single))
@@ -1,14 +1,14 @@
 """
-AVL Tree implementation with support for byte range search
-for nodes with a "size" parameter
+AVL Tree implementation, used for the XISO directory trees
+(see IntervalIndex for byte range search)
 """
 
 class AVLTree:
     """
-    An AVL tree with support for byte range search.
+    An AVL tree.
     The entries are expected to be dictionaries with:
     - offset (int or string, it's the node value)
-    - size (int, for byte range search, only when the offset is int)
+    - size (int)
     - data (dictionary or string)
     """
 
@@ -58,74 +58,6 @@ class AVLTree:
             if node.right:
                 self.traverse_tree(node.right, res)
 
-    def get_nodes_in_range(self, start, end):
-        """
-        Retrieves the nodes within a byte range (delimited by start and end),
-        plus start and end padding entries if needed, with the byte range and
-        padding for each node.
-        """
-        res = []
-        self.search_nodes_in_range(self.root, start, end, res)
-
-        # padding for the first file
-        if len(res) > 0:
-            res[0]["start_padding"] = max(0, res[0]["offset"] - start)
-
-        # calculate paddings
-        for i in range(len(res) - 1):
-            e0 = res[i]
-            e1 = res[i + 1]
-            padding = e1["offset"] - (e0["offset"] + e0["size"])
-            max_padding_needed = end - (e0["offset"] + e0["size"])
-            padding_needed = min(padding, max_padding_needed)
-            res[i]["end_padding"] = padding_needed
-
-        # padding for the last file
-        if len(res) > 0:
-            end_padding = max(0, end - (res[-1]["offset"] + res[-1]["size"]))
-            res[-1]["end_padding"] = end_padding
-
-        # empty area, padding only
-        if len(res) == 0:
-            res.append({
-                'file': 'PAD:PAD',
-                'start': start,
-                'end': end,
-                'size': end - start,
-                'end_padding': 0,
-                'start_padding': 0
-            })
-
-        return res
-
-    def search_nodes_in_range(self, node, start, end, res):
-        s = start
-        e = end
-
-        if node is None:
-            return
-
-        if s <= node.value + node.size and node.value <= e:
-            self.search_nodes_in_range(node.left, s, e, res)
-
-            res.append({
-                "file": node.data,
-                "start": max(0, s - node.value),
-                "end": min(node.size, e - node.value),
-                "size": node.size,
-                "offset": node.value,
-                "start_padding": 0,
-                "end_padding": 0
-            })
-
-            self.search_nodes_in_range(node.right, s, e, res)
-
-        elif node.value + node.size < s:
-            self.search_nodes_in_range(node.right, s, e, res)
-
-        elif node.value > e:
-            self.search_nodes_in_range(node.left, s, e, res)
-
     def insert_node(self, root, value, size, data):
         # insert the node
         if root is None:
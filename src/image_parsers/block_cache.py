@@ -0,0 +1,120 @@
+from collections import OrderedDict
+import itertools
+import threading
+
+from .lru_cache import LRUCache
+
+
+BLOCK_SIZE = 64 * 1024
+
+block_caches = {}
+block_caches_lock = threading.Lock()
+image_ids = itertools.count()
+
+
+def get_block_cache(max_size):
+    """
+    Returns the process-wide block cache (the memory budget is shared by
+    all the images)
+    """
+    with block_caches_lock:
+        if "default" not in block_caches:
+            block_caches["default"] = BlockCache(max_size)
+        return block_caches["default"]
+
+
+def get_image_id():
+    """
+    Returns a new key prefix for the blocks of an image. Each parse gets
+    its own, so the blocks built with other patches (or from an older
+    version of the file) are never served.
+    """
+    return next(image_ids)
+
+
+def iter_cached_segments(start, end, block_size, get_block, iter_source):
+    """
+    Yields the segments of a byte range, taking the aligned blocks that
+    get_block(index) returns from memory and the rest (in spans as large as
+    possible) from iter_source(start, end)
+    """
+    pos = start
+    source_start = start
+    while pos < end:
+        index = pos // block_size
+        block_end = min(end, (index + 1) * block_size)
+        block = get_block(index)
+        if block is not None:
+            if source_start < pos:
+                yield from iter_source(source_start, pos)
+            offset = index * block_size
+            yield memoryview(block)[pos - offset:block_end - offset]
+            source_start = block_end
+        pos = block_end
+    if source_start < end:
+        yield from iter_source(source_start, end)
+
+
+class BlockCache:
+    """
+    LRU cache of aligned blocks of XISO output (patches applied), keyed by
+    (image id, block index).
+    A block is only stored the second time it's missed within the recent
+    misses, so a single sequential pass doesn't flush the hot blocks
+    (headers, directory tables, frequently read files).
+    """
+
+    def __init__(self, max_size):
+        self.cache = LRUCache(max_size)
+        self.lock = threading.Lock()
+        self.recent_misses = OrderedDict()
+        self.max_recent_misses = 2 * max(1, max_size // BLOCK_SIZE)
+        self.admitted = 0
+
+    def get_block(self, parser, image_id, index):
+        """
+        Returns the block if cached (or missed recently, in which case it's
+        assembled and stored), None otherwise
+        """
+        key = (image_id, index)
+        block = self.cache.get(key)
+        if block is not None:
+            return block
+        with self.lock:
+            if key not in self.recent_misses:
+                self.recent_misses[key] = True
+                if len(self.recent_misses) > self.max_recent_misses:
+                    self.recent_misses.popitem(last=False)
+                return None
+            del self.recent_misses[key]
+        start = index * BLOCK_SIZE
+        end = min(start + BLOCK_SIZE, parser.get_size())
+        block = bytes(parser.assemble_range(start, end))
+        self.cache.put(key, block)
+        self.admitted += 1
+        return block
+
+    def iter_segments_in_range(self, parser, image_id, start, end):
+        """
+        Like ImageParser.iter_segments_in_range, with the cached blocks
+        served from memory
+        """
+        def get_block(index):
+            return self.get_block(parser, image_id, index)
+        return iter_cached_segments(start, end, BLOCK_SIZE, get_block,
+                                    parser.iter_uncached_segments_in_range)
+
+    def invalidate(self, image_id):
+        """
+        Removes the blocks of an image
+        """
+        self.cache.remove_if(lambda key: key[0] == image_id)
+        with self.lock:
+            keys = [k for k in self.recent_misses if k[0] == image_id]
+            for key in keys:
+                del self.recent_misses[key]
+
+    def get_stats(self):
+        stats = self.cache.get_stats()
+        stats["admitted"] = self.admitted
+        return stats
@@ -2,7 +2,9 @@
 # https://github.com/antangelo/xdvdfs
 # See Notice.txt for licensing information
 
-from .image_parser import XBE_HEADER
+import posixpath
+
+from .image_parser import FileExtent, XBE_HEADER
 from .other_formats_parser import OtherFormatsParser
 
 
@@ -12,22 +14,21 @@ class DirectoryParser(OtherFormatsParser):
     The input file is expected to be (or contain) the default.xbe file
     """
 
-    def get_file_data_in_range(self, node):
-        f = self.f
-        filename = node["file"].split(":")[1]
-        f2 = f.open_subfile(filename)
-        f2.seek(node["start"])
-        data = f2.read(node["end"] - node["start"])
-        f.close_subfile(f2)
-        return data
+    def read_file_data_in_range(self, node, buf):
+        filename = node.file.split(":", 1)[1]
+        self.f.readinto_subfile_at(filename, node.start, buf)
+
+    def get_file_extent(self, node):
+        filename = node.file.split(":", 1)[1]
+        length = node.end - node.start
+        return FileExtent(self.f, filename, node.start, length)
 
     def get_file_data(self, filename, start, length):
-        f = self.f
-        f2 = f.open_subfile(filename)
-        f2.seek(start)
-        data = f2.read(length)
-        f.close_subfile(f2)
-        return data
+        return self.f.read_subfile_at(filename, start, length)
+
+    def get_identity(self):
+        # the loose files can change without the default.xbe changing
+        return self.f.get_tree_identity()
 
     def test_file(self):
         if not self.f.valid('default.xbe'):
@@ -44,8 +45,9 @@ class DirectoryParser(OtherFormatsParser):
             nodes = []
             node_size = 0
             for file in files:
-                filepath = (root.replace("\\","/") + "/" + file).strip('/')
-                filepath2 = filepath[(len(start_path)):].strip('/')
+                # absolute paths keep their leading slash (POSIX)
+                filepath = posixpath.join(root.replace("\\","/"), file)
+                filepath2 = filepath.strip('/')[(len(start_path)):].strip('/')
                 filename = filepath2.split("/")[-1]
                 size = self.f.get_subfile_size(filepath)
 
@@ -76,7 +78,8 @@ class DirectoryParser(OtherFormatsParser):
                     "entry_size": entry_size,
                     "folder": True
                 })
-            rootname = root[(len(start_path)):].replace("\\","/").strip('/')
+            rootname = root.replace("\\","/").strip('/')[(len(start_path)):]
+            rootname = rootname.strip('/')
             res = {
                 "nodes": nodes,
                 "size": node_size
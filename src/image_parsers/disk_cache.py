@@ -0,0 +1,81 @@
+import hashlib
+import json
+import marshal
+import os
+import tempfile
+
+
+CACHE_FORMAT_VERSION = 2
+disk_caches = {}
+
+
+def get_cache_key(*parts):
+    """
+    Returns a hex digest identifying the input (JSON serializable) parts
+    """
+    data = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def get_disk_cache(directory, namespace):
+    """
+    Returns the shared DiskCache for the specified directory and namespace
+    """
+    key = (directory, namespace)
+    if key not in disk_caches:
+        disk_caches[key] = DiskCache(directory, namespace)
+    return disk_caches[key]
+
+
+class DiskCache:
+    """
+    Persistent key-value cache stored as one file per entry.
+    Values are serialized with marshal, so they can only contain
+    builtin types (dict, list, tuple, str, bytes, int, bool, None).
+    Entries are never updated in place, a changed input has a new key.
+    """
+
+    def __init__(self, directory, namespace):
+        self.directory = os.path.join(directory, namespace)
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def load(self, key):
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                version, value = marshal.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (EOFError, ValueError, TypeError) as e:
+            print("Ignoring invalid cache entry " + key + ": " + str(e))
+            self.misses += 1
+            return None
+        if version != CACHE_FORMAT_VERSION:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def store(self, key, value):
+        tmp_path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # write to a temporary file first, so that readers never see a
+            # partially written entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump((CACHE_FORMAT_VERSION, value), f)
+            os.replace(tmp_path, self.get_path(key))
+        except (OSError, ValueError) as e:
+            print("Unable to write cache entry " + key + ": " + str(e))
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
@@ -1,8 +1,11 @@
 # Relies on: https://github.com/chyyran/chd-rs-py
 # See Notice.txt for licensing information
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import fnmatch
 import os
+import queue
+import threading
 
 try:
     # optional import
@@ -13,65 +16,292 @@ except ImportError:
         raise ImportError()
     CHD_ENABLED = False
 
+from ..lru_cache import LRUCache
 from .file_reader import FileReader
 
 
+CHD_SECTOR_SIZE = 2448
+SECTOR_SIZE = 2048
+DEFAULT_CACHE_SIZE = 64 # MiB
+DEFAULT_READAHEAD = 8 # hunks
+READAHEAD_STREAMS = 4
+DEFAULT_WORKERS = 4
+process_handles = {}
+
+
+def strip_subchannel(raw, sectors):
+    """
+    Returns the sector data of a raw hunk, without the subchannel data
+    """
+    view = memoryview(raw)
+    starts = [i * CHD_SECTOR_SIZE for i in range(sectors)]
+    return b''.join([view[i:i + SECTOR_SIZE] for i in starts])
+
+
+def decode_hunk_in_process(filepath, hunk, sectors):
+    """
+    Decodes a hunk in a worker process (used with --chd_pool process),
+    with a CHD handle kept open for each file.
+    """
+    handle = process_handles.get(filepath)
+    if handle is None:
+        handle = chd_open(filepath)
+        process_handles[filepath] = handle
+    return strip_subchannel(handle.hunk(hunk), sectors)
+
+
+class ReadaheadStream:
+    """
+    A sequential access stream detected by ChdReader.
+    The generation is incremented when the stream is replaced,
+    to cancel its queued hunks.
+    """
+    __slots__ = ("last_hunk", "queued_until", "generation")
+
+    def __init__(self):
+        self.last_hunk = -2
+        self.queued_until = 0
+        self.generation = 0
+
+
 class ChdReader(FileReader):
     """
     Handles CHD file reading.
     Only handles archives containing a single file.
+    Decoded hunks are kept in a LRU cache (--chd_cache_size MiB), and the
+    hunks following a sequential access are decoded in advance on a
+    background thread (--chd_readahead hunks).
+    The CHD handles are not thread-safe, so each decoding thread gets its
+    own from a pool.
+    Reads spanning several hunks that are not cached decode them in
+    parallel (--chd_workers), on threads or on processes (--chd_pool).
     """
-    def __init__(self, filepath):
+    sendfile_enabled = False
+    readahead_default = True
+
+    def __init__(self, filepath, args=None):
         self.filepath = filepath
+        self.args = args
         self.hunk_size = 0
-        self.hunk = 0
+        self.hunk_count = 0
         self.pos = 0
-        self.buffer = None
         self.f = None
+        self.lock = threading.Lock()
+        self.handles = []
+        self.decoding = {}
+        cache_size = DEFAULT_CACHE_SIZE
+        self.readahead = DEFAULT_READAHEAD
+        self.workers = DEFAULT_WORKERS
+        self.pool_type = "thread"
+        if args is not None:
+            cache_size = args.chd_cache_size
+            self.readahead = args.chd_readahead
+            self.workers = args.chd_workers
+            self.pool_type = args.chd_pool
+        self.executor = None
+        self.process_executor = None
+        self.cache = LRUCache(cache_size * 1024 * 1024)
+        self.streams = []
+        self.readahead_queue = queue.Queue()
+        self.readahead_thread = None
+        self.readahead_decoded = 0
 
     def open(self):
-        if self.f is not None:
-            return
-        self.f = chd_open(self.filepath)
-        self.hunk_size = (self.f.header().hunk_size() // 2448) * 2048
+        with self.lock:
+            if self.f is not None:
+                return
+            self.f = chd_open(self.filepath)
+            sectors = self.f.header().hunk_size() // CHD_SECTOR_SIZE
+            self.hunk_size = sectors * SECTOR_SIZE
+            self.hunk_count = self.get_size() // self.hunk_size
 
     def close(self):
         # keep it open for better performance
         pass
 
+    def close_forced(self):
+        # cancel the queued hunks and wait for the readahead thread (it
+        # skips them before reaching the end marker) before closing
+        with self.lock:
+            for stream in self.streams:
+                stream.generation += 1
+            self.streams = []
+            thread = self.readahead_thread
+            self.readahead_thread = None
+        if thread is not None:
+            self.readahead_queue.put(None)
+            thread.join()
+        with self.lock:
+            self.f = None
+            self.handles = []
+            executors = [self.executor, self.process_executor]
+            self.executor = None
+            self.process_executor = None
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=False)
+        self.cache.clear()
+
     def seek(self, n):
-        hunk = n // self.hunk_size
-        if hunk != self.hunk:
-            self.hunk = hunk
-            self.buffer = self.f.hunk(self.hunk)
-        self.pos = n % self.hunk_size
+        self.pos = n
 
     def read(self, n):
         data = bytearray(n)
-        left = n
-        i0 = 0
-        while left > 0:
-            if self.pos >= self.hunk_size:
-                self.hunk += 1
-                self.buffer = self.f.hunk(self.hunk)
-                self.pos = 0
-            subhunk = (self.pos // 2048)
-            subhunk_end = (subhunk + 1) * 2048
-            next_pos = min(self.hunk_size, self.pos + left, subhunk_end)
-            offset = 400 * subhunk
-            j0 = offset + self.pos
-            j1 = offset + next_pos
-            delta = j1 - j0
-            i1 = i0 + delta
-            data[i0:i1] = self.buffer[j0:j1]
-            self.pos = next_pos
-            left -= delta
-            i0 = i1
+        n = self.readinto(memoryview(data))
+        del data[n:]
         return bytes(data)
 
+    def readinto(self, buf):
+        n = self.readinto_at(self.pos, buf)
+        self.pos += n
+        return n
+
+    def readinto_at(self, offset, buf):
+        n = len(buf)
+        hunk = offset // self.hunk_size
+        pos = offset % self.hunk_size
+        last_hunk = min((offset + n - 1) // self.hunk_size,
+                        self.hunk_count - 1)
+        self.schedule_readahead(hunk, last_hunk)
+        decoded = self.decode_hunks_in_parallel(hunk, last_hunk)
+        i0 = 0
+        while i0 < n and hunk < self.hunk_count:
+            data = decoded.get(hunk)
+            if data is None:
+                data = self.get_hunk(hunk)
+            delta = min(self.hunk_size - pos, n - i0)
+            buf[i0:i0 + delta] = data[pos:pos + delta]
+            i0 += delta
+            hunk += 1
+            pos = 0
+        return i0
+
+    def decode_hunks_in_parallel(self, first, last):
+        """
+        Decodes the hunks in the first..last range that are not cached,
+        in parallel on the worker pool, if there are at least two of them.
+        Returns a dictionary with the hunk as key and the data as value.
+        """
+        if self.workers <= 1 or last <= first:
+            return {}
+        missing = [h for h in range(first, last + 1) if h not in self.cache]
+        if len(missing) < 2:
+            return {}
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers)
+                if self.pool_type == "process":
+                    self.process_executor = ProcessPoolExecutor(self.workers)
+        return dict(zip(missing, self.executor.map(self.get_hunk, missing)))
+
+    def get_hunk(self, hunk):
+        """
+        Returns the data of the specified hunk (without the subchannel data),
+        from the cache or decoding it.
+        A hunk already being decoded by another thread is waited for.
+        """
+        while True:
+            data = self.cache.get(hunk)
+            if data is not None:
+                return data
+            with self.lock:
+                event = self.decoding.get(hunk)
+                owner = event is None
+                if owner:
+                    event = threading.Event()
+                    self.decoding[hunk] = event
+            if owner:
+                break
+            event.wait()
+        try:
+            data = self.decode_hunk(hunk)
+            self.cache.put(hunk, data)
+        finally:
+            with self.lock:
+                del self.decoding[hunk]
+            event.set()
+        return data
+
+    def decode_hunk(self, hunk):
+        sectors = self.hunk_size // SECTOR_SIZE
+        if self.process_executor is not None:
+            future = self.process_executor.submit(decode_hunk_in_process,
+                                                  self.filepath, hunk, sectors)
+            return future.result()
+        with self.lock:
+            handle = self.handles.pop() if self.handles else None
+        if handle is None:
+            handle = chd_open(self.filepath)
+        try:
+            raw = handle.hunk(hunk)
+        finally:
+            with self.lock:
+                self.handles.append(handle)
+        return strip_subchannel(raw, sectors)
+
+    def schedule_readahead(self, first, last):
+        """
+        Queues the hunks after last for decoding if the access continues one
+        of the recent streams, otherwise replaces the least recently used
+        stream (cancelling its queued hunks).
+        """
+        if self.readahead <= 0:
+            return
+        with self.lock:
+            stream = None
+            for s in self.streams:
+                if s.last_hunk <= first <= s.last_hunk + 1:
+                    stream = s
+                    break
+            if stream is None:
+                if len(self.streams) >= READAHEAD_STREAMS:
+                    stream = self.streams.pop(0)
+                    stream.generation += 1
+                else:
+                    stream = ReadaheadStream()
+                stream.last_hunk = last
+                stream.queued_until = last + 1
+                self.streams.append(stream)
+                return
+            self.streams.remove(stream)
+            self.streams.append(stream)
+            stream.last_hunk = last
+            start = max(last + 1, stream.queued_until)
+            end = min(last + 1 + self.readahead, self.hunk_count)
+            stream.queued_until = max(stream.queued_until, end)
+            generation = stream.generation
+            if self.readahead_thread is None and start < end:
+                self.readahead_thread = threading.Thread(
+                    target=self.readahead_worker, daemon=True)
+                self.readahead_thread.start()
+        for hunk in range(start, end):
+            self.readahead_queue.put((stream, generation, hunk))
+
+    def readahead_worker(self):
+        while True:
+            item = self.readahead_queue.get()
+            if item is None:
+                return
+            stream, generation, hunk = item
+            if stream.generation != generation or hunk in self.cache:
+                continue
+            try:
+                self.get_hunk(hunk)
+                self.readahead_decoded += 1
+            except Exception as e:
+                print("CHD readahead failed: " + str(e))
+
+    def get_stats(self):
+        stats = self.cache.get_stats()
+        stats["readahead_decoded"] = self.readahead_decoded
+        return stats
+
     def get_size(self):
         return len(self.f) * 16 * 1024
 
+    def get_tree_identity(self):
+        raise FileNotFoundError("not available")
+
     def walk(self):
         raise FileNotFoundError("not available")
 
@@ -81,12 +311,6 @@ class ChdReader(FileReader):
     def get_subfile_size(self, file):
         raise FileNotFoundError("not available")
 
-    def open_subfile(self, file):
-        raise FileNotFoundError("not available")
-
-    def close_subfile(self, file):
-        raise FileNotFoundError("not available")
-
     def valid(self, pattern):
         pattern = "*.chd"
         fn = os.path.basename(self.filepath)
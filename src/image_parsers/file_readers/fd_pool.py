@@ -0,0 +1,150 @@
+from collections import OrderedDict
+import threading
+
+try:
+    import resource
+    RESOURCE_ENABLED = True
+except ImportError:
+    RESOURCE_ENABLED = False
+
+
+DEFAULT_POOL_SIZE = 256
+# part of the descriptor limit left to the pool (sockets, images, caches...)
+POOL_LIMIT_FRACTION = 4
+
+fd_pools = {}
+fd_pools_lock = threading.Lock()
+
+
+def get_fd_limit():
+    """
+    Returns the soft limit of open file descriptors, or None if unknown
+    """
+    if not RESOURCE_ENABLED:
+        return None
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return soft
+
+
+def get_default_pool_size():
+    limit = get_fd_limit()
+    if limit is None:
+        return DEFAULT_POOL_SIZE
+    return max(1, min(DEFAULT_POOL_SIZE, limit // POOL_LIMIT_FRACTION))
+
+
+def get_fd_pool(max_open=None):
+    """
+    Returns the process-wide pool (the descriptor limit is per process)
+    """
+    with fd_pools_lock:
+        if "default" not in fd_pools:
+            if not max_open:
+                max_open = get_default_pool_size()
+            fd_pools["default"] = FdPool(max_open)
+        return fd_pools["default"]
+
+
+class PooledFile:
+    __slots__ = ("f", "lock", "refcount")
+
+    def __init__(self, f):
+        self.f = f
+        # for the readers without positional reads
+        self.lock = threading.Lock()
+        self.refcount = 0
+
+
+class FdPool:
+    """
+    Least recently used pool of open files (in binary read mode), keyed by
+    absolute path. The files are reference counted, only the ones not in
+    use are closed when the pool is full (it can temporarily grow beyond
+    max_open if all of them are in use).
+    """
+
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, path):
+        """
+        Returns the PooledFile for the path, opening it if needed.
+        Must be paired with a release call.
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.entries.move_to_end(path)
+                entry.refcount += 1
+                self.hits += 1
+                return entry
+            self.misses += 1
+        # open outside of the lock, other threads can use the pool meanwhile
+        f = open(path, 'rb')
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                # opened concurrently by another thread
+                f.close()
+            else:
+                entry = PooledFile(f)
+                self.entries[path] = entry
+            self.entries.move_to_end(path)
+            entry.refcount += 1
+            to_close = self.evict()
+        self.close_files(to_close)
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refcount -= 1
+            to_close = self.evict()
+        self.close_files(to_close)
+
+    def evict(self):
+        # called with the lock held, returns the files to close
+        to_close = []
+        if len(self.entries) <= self.max_open:
+            return to_close
+        for path in list(self.entries.keys()):
+            if len(self.entries) <= self.max_open:
+                break
+            entry = self.entries[path]
+            if entry.refcount == 0:
+                del self.entries[path]
+                to_close.append(entry.f)
+                self.evictions += 1
+        return to_close
+
+    def close_files(self, files):
+        for f in files:
+            f.close()
+
+    def clear(self):
+        with self.lock:
+            to_close = []
+            for path in list(self.entries.keys()):
+                entry = self.entries[path]
+                if entry.refcount == 0:
+                    del self.entries[path]
+                    to_close.append(entry.f)
+        self.close_files(to_close)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "open": len(self.entries),
+                "max_open": self.max_open,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0
+            }
@@ -1,32 +1,127 @@
 import fnmatch
 import os
 import struct
+import threading
+
+from .fd_pool import get_fd_pool
+
+
+# positional reads don't share the file position, so they are thread-safe
+# (not available on Windows, where seek and read are used under a lock)
+PREADV_ENABLED = hasattr(os, 'preadv')
+PREAD_ENABLED = hasattr(os, 'pread')
+SENDFILE_ENABLED = hasattr(os, 'sendfile')
+
+
+def preadinto(f, offset, buf, lock=None):
+    """
+    Reads into buf from the file object f, starting at offset, without
+    relying on the shared file position (unless positional reads are not
+    available, in which case the optional lock is held while seeking).
+    Returns the number of bytes read (less than len(buf) only at EOF).
+    """
+    if not PREAD_ENABLED:
+        if lock is None:
+            f.seek(offset)
+            return f.readinto(buf)
+        with lock:
+            f.seek(offset)
+            return f.readinto(buf)
+    fd = f.fileno()
+    n = 0
+    length = len(buf)
+    while n < length:
+        if PREADV_ENABLED:
+            k = os.preadv(fd, [buf[n:]], offset + n)
+        else:
+            chunk = os.pread(fd, length - n, offset + n)
+            k = len(chunk)
+            buf[n:n + k] = chunk
+        if k == 0:
+            break
+        n += k
+    return n
 
 
 class FileReader():
     """
     Handles file reading, with convenience methods for integers.
     Allows to switch to other files.
+    The read_at/readinto_at methods (and their subfile counterparts) don't
+    use the shared position, so they can be used from multiple threads.
     """
-    def __init__(self, filepath):
+    # whether the data can be sent straight from the file to a socket
+    sendfile_enabled = SENDFILE_ENABLED
+    # whether get_view can return the data without copying it
+    views_enabled = False
+    # whether the output is prefetched with --readahead auto
+    readahead_default = False
+
+    def __init__(self, filepath, args=None):
         self.filepath = filepath
+        self.args = args
         self.f = None
+        self.lock = threading.Lock()
+        self.subfile_paths = {}
+        self.root_path = None
 
     def open(self):
-        self.f = open(self.filepath, 'rb')
+        with self.lock:
+            if self.f is not None and not self.f.closed:
+                return
+            self.f = open(self.filepath, 'rb')
 
     def close(self):
         self.f.close()
 
+    def close_forced(self):
+        """
+        Releases the resources of the reader when it's not used anymore
+        """
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+
     def seek(self, n):
         self.f.seek(n)
 
     def read(self, n):
         return self.f.read(n)
 
+    def readinto(self, buf):
+        return self.f.readinto(buf)
+
+    def read_at(self, offset, length):
+        data = bytearray(length)
+        n = self.readinto_at(offset, memoryview(data))
+        del data[n:]
+        return bytes(data)
+
+    def readinto_at(self, offset, buf):
+        return preadinto(self.f, offset, buf, self.lock)
+
     def get_size(self):
         return os.path.getsize(self.filepath)
 
+    def get_identity(self):
+        """
+        Returns the path, size and modification time of the file
+        """
+        st = os.stat(self.filepath)
+        return [os.path.abspath(self.filepath), st.st_size, st.st_mtime_ns]
+
+    def get_tree_identity(self):
+        """
+        Like get_identity, but for all the files in the root directory
+        """
+        res = [os.path.abspath(self.get_root())]
+        for root, dirs, files in self.walk():
+            for name in dirs + files:
+                st = os.stat(os.path.join(root, name))
+                res.append([os.path.join(root, name), st.st_size,
+                            st.st_mtime_ns])
+        return res
+
     def walk(self):
         return os.walk(self.get_root())
 
@@ -36,13 +131,69 @@ class FileReader():
     def get_subfile_size(self, file):
         return os.path.getsize(file)
 
-    def open_subfile(self, file):
-        rel_path = os.path.relpath(self.get_root(), os.getcwd())
-        file = os.path.join(rel_path, file)
-        return open(file, 'rb')
-
-    def close_subfile(self, file):
-        file.close()
+    def get_subfile_path(self, file):
+        """
+        Returns the absolute path of a subfile (computed once per file)
+        """
+        path = self.subfile_paths.get(file)
+        if path is None:
+            if self.root_path is None:
+                self.root_path = os.path.abspath(self.get_root())
+            path = os.path.join(self.root_path, file)
+            self.subfile_paths[file] = path
+        return path
+
+    def get_fd_pool(self):
+        max_open = None
+        if self.args is not None:
+            max_open = self.args.fd_pool_size
+        return get_fd_pool(max_open)
+
+    def read_subfile_at(self, file, offset, length):
+        data = bytearray(length)
+        n = self.readinto_subfile_at(file, offset, memoryview(data))
+        del data[n:]
+        return bytes(data)
+
+    def readinto_subfile_at(self, file, offset, buf):
+        # the handles are shared through the pool, positional reads only
+        path = self.get_subfile_path(file)
+        pool = self.get_fd_pool()
+        entry = pool.acquire(path)
+        try:
+            return preadinto(entry.f, offset, buf, entry.lock)
+        finally:
+            pool.release(entry)
+
+    def get_view(self, file, offset, length):
+        """
+        Returns a memoryview of the data of the image (file is None) or of
+        the specified subfile, if the reader supports it (None otherwise)
+        """
+        return None
+
+    def can_sendfile(self, file):
+        """
+        Whether sendfile can be used for the image itself (file is None)
+        or for the specified subfile
+        """
+        return self.sendfile_enabled
+
+    def sendfile(self, sock, file, offset, length):
+        """
+        Sends length bytes at offset straight to the socket, from the image
+        itself if file is None, otherwise from the specified subfile.
+        """
+        if file is None:
+            sock.sendfile(self.f, offset, length)
+            return
+        path = self.get_subfile_path(file)
+        pool = self.get_fd_pool()
+        entry = pool.acquire(path)
+        try:
+            sock.sendfile(entry.f, offset, length)
+        finally:
+            pool.release(entry)
 
     def valid(self, pattern):
         fn = os.path.basename(self.filepath)
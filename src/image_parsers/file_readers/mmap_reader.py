@@ -0,0 +1,148 @@
+from collections import OrderedDict
+import mmap
+import sys
+import threading
+
+from .file_reader import FileReader, SENDFILE_ENABLED
+
+
+# mapping multi-GB images needs a 64-bit address space
+MMAP_ENABLED = sys.maxsize > 2 ** 32
+MADVISE_ENABLED = hasattr(mmap.mmap, 'madvise') and \
+                  hasattr(mmap, 'MADV_RANDOM') and \
+                  hasattr(mmap, 'MADV_WILLNEED')
+READAHEAD_WINDOW = 4 * 1024 * 1024
+
+
+class MmapFileReader(FileReader):
+    """
+    Like FileReader, but reads the image (or the subfiles, mapped lazily
+    when first read) through memory maps.
+    Unpatched file data is served as memoryview slices of the maps, without
+    syscalls or copies in Python.
+    The maps are advised for random access, and the next READAHEAD_WINDOW
+    bytes are prefetched when the reads are sequential.
+    Falls back to the FileReader behavior on 32-bit hosts.
+    """
+    sendfile_enabled = SENDFILE_ENABLED and not MMAP_ENABLED
+    views_enabled = MMAP_ENABLED
+
+    def __init__(self, filepath, args=None):
+        super().__init__(filepath, args)
+        self.map = None
+        self.subfile_maps = OrderedDict()
+        self.maps_lock = threading.Lock()
+        self.last_read = None
+
+    def open(self):
+        super().open()
+        with self.lock:
+            if self.map is None and MMAP_ENABLED:
+                self.map = self.create_map(self.f)
+
+    def create_map(self, f):
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # e.g. empty files
+            return None
+        if MADVISE_ENABLED:
+            m.madvise(mmap.MADV_RANDOM)
+        return m
+
+    def close(self):
+        # keep the maps, views of them can still be in use
+        pass
+
+    def close_forced(self):
+        with self.maps_lock:
+            maps = [self.map] + list(self.subfile_maps.values())
+            self.map = None
+            self.subfile_maps.clear()
+        for m in maps:
+            self.close_map(m)
+        super().close_forced()
+
+    def close_map(self, m):
+        if m is None:
+            return
+        try:
+            m.close()
+        except BufferError:
+            # still exported, closed when the last view is released
+            pass
+
+    def get_subfile_map(self, file):
+        """
+        Returns the map of a subfile (None if it can't be mapped), the last
+        used ones are kept (each map keeps a descriptor open)
+        """
+        path = self.get_subfile_path(file)
+        with self.maps_lock:
+            if path in self.subfile_maps:
+                self.subfile_maps.move_to_end(path)
+                return self.subfile_maps[path]
+        with open(path, 'rb') as f:
+            m = self.create_map(f)
+        with self.maps_lock:
+            if path in self.subfile_maps:
+                # mapped concurrently by another thread
+                m = self.subfile_maps[path]
+            else:
+                self.subfile_maps[path] = m
+            max_maps = self.get_fd_pool().max_open
+            while len(self.subfile_maps) > max_maps:
+                # not closed explicitly, other threads can still be reading
+                # it: it's closed when the last reference is gone
+                self.subfile_maps.popitem(last=False)
+        return m
+
+    def get_map(self, file):
+        if file is None:
+            return self.map
+        return self.get_subfile_map(file)
+
+    def advise(self, m, offset, length):
+        """
+        Prefetches the data following a read if it continues the previous
+        read of the same map
+        """
+        if not MADVISE_ENABLED:
+            return
+        end = offset + length
+        sequential = self.last_read == (id(m), offset)
+        self.last_read = (id(m), end)
+        if sequential and end < len(m):
+            start = end - end % mmap.PAGESIZE
+            length = min(READAHEAD_WINDOW, len(m) - start)
+            m.madvise(mmap.MADV_WILLNEED, start, length)
+
+    def get_view(self, file, offset, length):
+        """
+        Returns a memoryview of the data at offset of the image (file is
+        None) or of the specified subfile, None if not mapped
+        """
+        m = self.get_map(file)
+        if m is None or offset + length > len(m):
+            return None
+        self.advise(m, offset, length)
+        return memoryview(m)[offset:offset + length]
+
+    def readinto_map(self, m, offset, buf):
+        n = min(len(buf), max(0, len(m) - offset))
+        self.advise(m, offset, n)
+        with memoryview(m) as view:
+            buf[:n] = view[offset:offset + n]
+        return n
+
+    def readinto_at(self, offset, buf):
+        m = self.map
+        if m is None:
+            return super().readinto_at(offset, buf)
+        return self.readinto_map(m, offset, buf)
+
+    def readinto_subfile_at(self, file, offset, buf):
+        m = self.get_subfile_map(file) if MMAP_ENABLED else None
+        if m is None:
+            return super().readinto_subfile_at(file, offset, buf)
+        return self.readinto_map(m, offset, buf)
@@ -0,0 +1,282 @@
+"""
+Random access readers for the members of a zip archive
+"""
+
+from bisect import bisect_right
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+from .file_reader import preadinto
+
+
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+LOCAL_HEADER_SIZE = 30
+INPUT_CHUNK_SIZE = 64 * 1024
+OUTPUT_CHUNK_SIZE = 256 * 1024
+CACHE_CHUNK_SIZE = 256 * 1024
+PWRITE_ENABLED = hasattr(os, 'pwrite')
+
+
+def get_data_offset(raw, info, lock):
+    """
+    Returns the absolute offset of the data of a member in the archive file,
+    reading the sizes of the variable fields from its local header
+    (they can differ from the ones in the central directory).
+    The lock of the archive file is used if positional reads are not
+    available.
+    """
+    header = bytearray(LOCAL_HEADER_SIZE)
+    n = preadinto(raw, info.header_offset, memoryview(header), lock)
+    if n < LOCAL_HEADER_SIZE or header[0:4] != LOCAL_HEADER_SIGNATURE:
+        raise ValueError("invalid local header for " + info.filename)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+class StoredMember:
+    """
+    Reads an uncompressed member with positional reads on the archive file
+    (raw_lock is the lock of the archive file, shared by its members)
+    """
+
+    def __init__(self, raw, raw_lock, data_offset, file_size):
+        self.raw = raw
+        self.raw_lock = raw_lock
+        self.data_offset = data_offset
+        self.file_size = file_size
+
+    def readinto_at(self, offset, buf):
+        n = min(len(buf), max(0, self.file_size - offset))
+        return preadinto(self.raw, self.data_offset + offset, buf[:n],
+                         self.raw_lock)
+
+    def close(self):
+        pass
+
+
+class ZipExtMember:
+    """
+    Reads a member through ZipFile.open (any compression supported by
+    zipfile), seeking under a lock.
+    """
+
+    def __init__(self, zip_file, info):
+        self.f = zip_file.open(info)
+        self.lock = threading.Lock()
+
+    def readinto_at(self, offset, buf):
+        with self.lock:
+            self.f.seek(offset)
+            return self.f.readinto(buf)
+
+    def close(self):
+        self.f.close()
+
+
+class DeflatedMember:
+    """
+    Random access to a deflated member, without restarting decompression
+    from the beginning on each backward seek.
+    While decompressing, a copy of the decompressor state (including the
+    32 KiB window) is saved every checkpoint_spacing bytes of output.
+    Seeks resume from the nearest checkpoint before the target.
+    raw_lock is the lock of the archive file, shared by its members.
+    The checkpoints only live in memory: zlib doesn't expose the bit level
+    positioning needed to recreate a state from a persisted window.
+    """
+
+    def __init__(self, raw, raw_lock, data_offset, compress_size, file_size,
+                 checkpoint_spacing):
+        self.raw = raw
+        self.raw_lock = raw_lock
+        self.data_offset = data_offset
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.spacing = checkpoint_spacing
+        self.lock = threading.Lock()
+        self.index_lock = threading.Lock()
+        self.indexing = False
+        self.closed = False
+        # checkpoints: output offsets, and (input offset, decompressor)
+        self.checkpoint_offsets = [0]
+        self.checkpoints = [(0, zlib.decompressobj(-zlib.MAX_WBITS))]
+        # current stream: the last output chunk and where it starts
+        self.stream = None
+        self.buffer = bytes(0)
+        self.buffer_start = 0
+
+    def restore(self, offset):
+        """
+        Restarts the stream from the nearest checkpoint before offset
+        """
+        with self.index_lock:
+            k = bisect_right(self.checkpoint_offsets, offset) - 1
+            out_pos = self.checkpoint_offsets[k]
+            in_pos, obj = self.checkpoints[k]
+            self.stream = [in_pos, out_pos, obj.copy()]
+        self.buffer = bytes(0)
+        self.buffer_start = out_pos
+
+    def step(self, stream):
+        """
+        Decompresses the next output chunk of a stream (a list with the input
+        offset, the output offset and the decompressor), adding a checkpoint
+        if needed. Returns an empty chunk at the end of the member.
+        """
+        in_pos, out_pos, obj = stream
+        out = bytes(0)
+        while len(out) == 0 and not obj.eof:
+            data = obj.unconsumed_tail
+            if len(data) == 0 and in_pos < self.compress_size:
+                length = min(INPUT_CHUNK_SIZE, self.compress_size - in_pos)
+                chunk = bytearray(length)
+                n = preadinto(self.raw, self.data_offset + in_pos,
+                              memoryview(chunk), self.raw_lock)
+                data = bytes(chunk[:n])
+                in_pos += n
+            # with all the input consumed, the decompressor can still hold
+            # output (if the last call was capped by OUTPUT_CHUNK_SIZE)
+            out = obj.decompress(data, OUTPUT_CHUNK_SIZE)
+            if len(out) == 0 and len(data) == 0:
+                break
+        out_pos += len(out)
+        stream[0] = in_pos
+        stream[1] = out_pos
+        if len(obj.unconsumed_tail) == 0:
+            self.add_checkpoint(in_pos, out_pos, obj)
+        return out
+
+    def add_checkpoint(self, in_pos, out_pos, obj):
+        with self.index_lock:
+            if out_pos >= self.checkpoint_offsets[-1] + self.spacing:
+                self.checkpoint_offsets.append(out_pos)
+                self.checkpoints.append((in_pos, obj.copy()))
+
+    def readinto_at(self, offset, buf):
+        n = min(len(buf), max(0, self.file_size - offset))
+        with self.lock:
+            if self.stream is None:
+                self.restore(offset)
+            i = 0
+            while i < n:
+                pos = offset + i
+                buffer_end = self.buffer_start + len(self.buffer)
+                if self.buffer_start <= pos < buffer_end:
+                    j = pos - self.buffer_start
+                    delta = min(n - i, len(self.buffer) - j)
+                    buf[i:i + delta] = self.buffer[j:j + delta]
+                    i += delta
+                    continue
+                # resume from a checkpoint if going back or if there is
+                # one closer than the current position
+                k = bisect_right(self.checkpoint_offsets, pos) - 1
+                if pos < self.buffer_start or \
+                   self.checkpoint_offsets[k] > buffer_end:
+                    self.restore(pos)
+                self.buffer_start = self.stream[1]
+                self.buffer = self.step(self.stream)
+                if len(self.buffer) == 0:
+                    break
+            return i
+
+    def build_index(self):
+        """
+        Decompresses the whole member once, saving the checkpoints
+        (called on a background thread).
+        """
+        with self.index_lock:
+            if self.indexing:
+                return
+            self.indexing = True
+            in_pos, obj = self.checkpoints[-1]
+            stream = [in_pos, self.checkpoint_offsets[-1], obj.copy()]
+        while not self.closed and len(self.step(stream)) > 0:
+            pass
+
+    def close(self):
+        self.closed = True
+
+
+class CachedMember:
+    """
+    Keeps the decompressed data of a member in aligned chunks, in a LRU
+    cache shared by all the members of the archive (keys are
+    (name, chunk index)), so alternating reads between members don't
+    decompress them again.
+    The (key, chunk) pairs evicted by the cache are passed to on_evict.
+    With spill enabled, the evicted chunks of this member can be written to
+    a sparse temporary file and read back from there.
+    """
+
+    def __init__(self, member, name, file_size, cache, on_evict,
+                 spill=False):
+        self.member = member
+        self.name = name
+        self.file_size = file_size
+        self.cache = cache
+        self.on_evict = on_evict
+        self.spill_lock = threading.Lock()
+        self.spill_file = tempfile.TemporaryFile() if spill else None
+        self.spilled = set()
+        self.spilled_size = 0
+        self.closed = False
+
+    def get_chunk(self, index):
+        key = (self.name, index)
+        chunk = self.cache.get(key)
+        if chunk is not None:
+            return chunk
+        start = index * CACHE_CHUNK_SIZE
+        chunk = bytearray(min(CACHE_CHUNK_SIZE, self.file_size - start))
+        if index in self.spilled:
+            n = preadinto(self.spill_file, start, memoryview(chunk),
+                          self.spill_lock)
+        else:
+            n = self.member.readinto_at(start, memoryview(chunk))
+        del chunk[n:]
+        chunk = bytes(chunk)
+        self.on_evict(self.cache.put(key, chunk))
+        return chunk
+
+    def readinto_at(self, offset, buf):
+        n = min(len(buf), max(0, self.file_size - offset))
+        i = 0
+        while i < n:
+            pos = offset + i
+            index = pos // CACHE_CHUNK_SIZE
+            chunk = self.get_chunk(index)
+            j = pos - index * CACHE_CHUNK_SIZE
+            delta = min(n - i, len(chunk) - j)
+            if delta <= 0:
+                break
+            buf[i:i + delta] = chunk[j:j + delta]
+            i += delta
+        return i
+
+    def spill(self, index, chunk):
+        if self.spill_file is None or index in self.spilled:
+            return
+        offset = index * CACHE_CHUNK_SIZE
+        with self.spill_lock:
+            if self.closed:
+                return
+            if PWRITE_ENABLED:
+                os.pwrite(self.spill_file.fileno(), chunk, offset)
+            else:
+                self.spill_file.seek(offset)
+                self.spill_file.write(chunk)
+            self.spilled.add(index)
+            self.spilled_size += len(chunk)
+
+    def build_index(self):
+        self.member.build_index()
+
+    def close(self):
+        self.member.close()
+        with self.spill_lock:
+            self.closed = True
+            if self.spill_file is not None:
+                self.spill_file.close()
@@ -1,39 +1,81 @@
+from collections import OrderedDict
 import fnmatch
 import os
-from zipfile import ZipFile, BadZipFile
+import queue
+import threading
+from zipfile import ZipFile, BadZipFile, ZIP_DEFLATED, ZIP_STORED
+import zlib
 
-from .file_reader import FileReader
+from .file_reader import FileReader, SENDFILE_ENABLED
+from .zip_members import (CachedMember, DeflatedMember, StoredMember,
+                          ZipExtMember, get_data_offset)
+from ..lru_cache import LRUCache
+
+
+DEFAULT_CHECKPOINT_SPACING = 4 # MiB
+DEFAULT_CACHE_SIZE = 64 # MiB
+MAX_CACHED_MEMBERS = 64
 
 
 class ZipReader(FileReader):
     """
-    Handles zip file reading. Experimental.
-    Zip files are expected to contain the raw files.
-    (e.g. with the default.xbe and all the other files)
-    Could work with zipped XISOs if the seek wasn't slow.
-    Warning: seek is slow with large files.
+    Handles zip file reading.
+    Zip files are expected to contain the raw files
+    (e.g. with the default.xbe and all the other files), or a XISO file.
+    Deflated members are read through a checkpoint index
+    (see DeflatedMember), so seeking doesn't restart the decompression.
+    The members larger than the checkpoint spacing are indexed in the
+    background when first read.
+    The decompressed data is kept in a LRU cache of chunks shared by all
+    the members (--zip_cache_size MiB), the chunks evicted from the members
+    larger than --zip_spill MiB are moved to a temporary file.
+    Stored members are read (and sent) straight from the archive file.
     """
-    def __init__(self, filepath):
+    sendfile_enabled = SENDFILE_ENABLED
+    readahead_default = True
+
+    def __init__(self, filepath, args=None):
         self.is_xbe = False
         self.pattern = None
-        self.f2 = None
+        self.main_file = None
         self.validated = False
-        self.cur_subfile = None
-        self.cur_subfile_handle = None
         self.closed = True
-        super().__init__(filepath)
+        self.raw = None
+        # for the reads of the archive file without positional reads
+        self.raw_lock = threading.Lock()
+        self.pos = 0
+        self.members = OrderedDict()
+        # readers of each member in use (by id), and the evicted members
+        # still in use, closed by their last reader
+        self.member_users = {}
+        self.evicted_members = {}
+        self.index_queue = queue.Queue()
+        self.index_thread = None
+        spacing = DEFAULT_CHECKPOINT_SPACING
+        cache_size = DEFAULT_CACHE_SIZE
+        spill_size = 0
+        if args is not None:
+            spacing = args.zip_checkpoint_spacing
+            cache_size = args.zip_cache_size
+            spill_size = args.zip_spill
+        self.checkpoint_spacing = spacing * 1024 * 1024
+        self.cache = LRUCache(cache_size * 1024 * 1024)
+        self.spill_size = spill_size * 1024 * 1024
+        super().__init__(filepath, args)
 
     def open(self):
-        if not self.closed:
-            return
-        self.f = ZipFile(self.filepath, 'r')
-        if self.validated and self.pattern is not None:
-            file = fnmatch.filter(self.f.namelist(), self.pattern)[0]
-            self.f2 = self.f.open(file)
-        self.closed = False
+        with self.lock:
+            if not self.closed:
+                return
+            self.f = ZipFile(self.filepath, 'r')
+            self.raw = open(self.filepath, 'rb')
+            if self.validated and self.pattern is not None:
+                files = fnmatch.filter(self.f.namelist(), self.pattern)
+                self.main_file = files[0] if len(files) > 0 else None
+            self.closed = False
 
     def check_f2(self):
-        if self.f2 is None:
+        if self.main_file is None:
             msg = "no files found matching pattern: " + self.pattern
             raise FileNotFoundError(msg)
 
@@ -42,27 +84,163 @@ class ZipReader(FileReader):
         pass
 
     def close_forced(self):
-        if self.f2 is not None:
-            self.f2.close()
-        if self.cur_subfile is not None:
-            self.cur_subfile = None
-            self.cur_subfile_handle.close()
-        self.f.close()
-        self.closed = True
+        with self.lock:
+            if self.closed:
+                return
+            members = list(self.members.values()) + \
+                      list(self.evicted_members.values())
+            for member in members:
+                member.close()
+            self.members.clear()
+            self.evicted_members.clear()
+            self.member_users.clear()
+            self.cache.clear()
+            if self.index_thread is not None:
+                self.index_queue.put(None)
+                self.index_thread = None
+            self.raw.close()
+            self.f.close()
+            self.closed = True
+
+    def get_member(self, file):
+        """
+        Returns the reader for the specified member, creating it if needed.
+        Must be followed by release_member(member).
+        Only the last used small members are kept, the large ones are kept
+        for their checkpoint index. The evicted members are closed when not
+        in use anymore.
+        """
+        to_close = []
+        with self.lock:
+            member = self.members.get(file)
+            if member is not None:
+                self.members.move_to_end(file)
+                self.add_member_user(member)
+                return member
+            info = self.f.getinfo(file)
+            encrypted = info.flag_bits & 0x1
+            if info.compress_type == ZIP_STORED and not encrypted:
+                data_offset = get_data_offset(self.raw, info, self.raw_lock)
+                member = StoredMember(self.raw, self.raw_lock, data_offset,
+                                      info.file_size)
+            elif info.compress_type == ZIP_DEFLATED and not encrypted:
+                data_offset = get_data_offset(self.raw, info, self.raw_lock)
+                member = DeflatedMember(self.raw, self.raw_lock, data_offset,
+                                        info.compress_size, info.file_size,
+                                        self.checkpoint_spacing)
+                if info.file_size > self.checkpoint_spacing:
+                    self.index_member(member)
+            else:
+                member = ZipExtMember(self.f, info)
+            if self.cache.max_size > 0 and \
+               not isinstance(member, StoredMember):
+                spill = self.spill_size > 0 and \
+                        info.file_size > self.spill_size
+                member = CachedMember(member, file, info.file_size,
+                                      self.cache, self.spill_evicted, spill)
+            self.members[file] = member
+            self.add_member_user(member)
+            small = [k for k, m in self.members.items()
+                     if not getattr(m, "file_size", 0) >
+                     self.checkpoint_spacing]
+            for k in small[:max(0, len(small) - MAX_CACHED_MEMBERS)]:
+                evicted = self.members.pop(k)
+                if id(evicted) in self.member_users:
+                    self.evicted_members[id(evicted)] = evicted
+                else:
+                    to_close.append(evicted)
+        for evicted in to_close:
+            evicted.close()
+        return member
+
+    def add_member_user(self, member):
+        # called with the lock held
+        key = id(member)
+        self.member_users[key] = self.member_users.get(key, 0) + 1
+
+    def release_member(self, member):
+        key = id(member)
+        with self.lock:
+            users = self.member_users.get(key, 0) - 1
+            if users > 0:
+                self.member_users[key] = users
+                return
+            self.member_users.pop(key, None)
+            evicted = self.evicted_members.pop(key, None)
+        if evicted is not None:
+            evicted.close()
+
+    def read_member(self, file, offset, buf):
+        member = self.get_member(file)
+        try:
+            return member.readinto_at(offset, buf)
+        finally:
+            self.release_member(member)
+
+    def spill_evicted(self, evicted):
+        """
+        Moves the chunks evicted from the cache to the spill files of their
+        members, if any
+        """
+        for (file, index), chunk in evicted:
+            with self.lock:
+                member = self.members.get(file)
+            if isinstance(member, CachedMember):
+                member.spill(index, chunk)
+
+    def get_stats(self):
+        stats = self.cache.get_stats()
+        with self.lock:
+            members = list(self.members.values())
+        stats["spilled_size"] = sum(m.spilled_size for m in members
+                                    if isinstance(m, CachedMember))
+        return stats
+
+    def index_member(self, member):
+        if self.index_thread is None:
+            self.index_thread = threading.Thread(target=self.index_worker,
+                                                 args=(self.index_queue,),
+                                                 daemon=True)
+            self.index_thread.start()
+        self.index_queue.put(member)
+
+    def index_worker(self, index_queue):
+        while True:
+            member = index_queue.get()
+            if member is None:
+                return
+            try:
+                member.build_index()
+            except (OSError, ValueError, zlib.error) as e:
+                print("Unable to index zip member: " + str(e))
 
     def seek(self, n):
-        self.check_f2()
-        self.f2.seek(n)
+        self.pos = n
 
     def read(self, n):
+        data = bytearray(n)
+        n = self.readinto(memoryview(data))
+        del data[n:]
+        return bytes(data)
+
+    def readinto(self, buf):
+        n = self.readinto_at(self.pos, buf)
+        self.pos += n
+        return n
+
+    def readinto_at(self, offset, buf):
         self.check_f2()
-        return self.f2.read(n)
+        return self.read_member(self.main_file, offset, buf)
 
     def get_size(self):
-        if self.f2 is not None:
-            return self.f.getinfo(self.f2.name).file_size
+        if self.main_file is not None:
+            return self.f.getinfo(self.main_file).file_size
         return super().get_size()
 
+    def get_tree_identity(self):
+        # the archive contains the whole tree
+        return self.get_identity()
+
     def walk(self):
         res = {}
 
@@ -91,19 +269,28 @@ class ZipReader(FileReader):
     def get_subfile_size(self, file):
         return self.f.getinfo(file).file_size
 
-    def open_subfile(self, file):
-        if self.cur_subfile != file:
-            if self.cur_subfile_handle is not None:
-                self.cur_subfile_handle.close()
-            self.cur_subfile = file
-            self.cur_subfile_handle = self.f.open(self.get_root() + file)
-            return self.cur_subfile_handle
-        else:
-            return self.cur_subfile_handle
-
-    def close_subfile(self, file):
-        # keep it open for better performance
-        pass
+    def readinto_subfile_at(self, file, offset, buf):
+        return self.read_member(self.get_root() + file, offset, buf)
+
+    def get_member_name(self, file):
+        if file is None:
+            self.check_f2()
+            return self.main_file
+        return self.get_root() + file
+
+    def can_sendfile(self, file):
+        if not self.sendfile_enabled:
+            return False
+        member = self.get_member(self.get_member_name(file))
+        self.release_member(member)
+        return isinstance(member, StoredMember)
+
+    def sendfile(self, sock, file, offset, length):
+        member = self.get_member(self.get_member_name(file))
+        try:
+            sock.sendfile(self.raw, member.data_offset + offset, length)
+        finally:
+            self.release_member(member)
 
     def valid(self, pattern):
         if self.filepath.split(".")[-1] != "zip":
@@ -5,9 +5,15 @@
 from abc import ABC, abstractmethod
 import fnmatch
 import json
+import time
 
+from .block_cache import get_block_cache, get_image_id
+from .disk_cache import get_cache_key, get_disk_cache
+from .interval_index import IntervalIndex, PAD_NODE
+from .patches.patch_overlay import PatchOverlay
 from .patches.patcher import Patcher
-from .avl_tree import AVLTree
+from .readahead import Readahead
+from . import stage_timer
 
 
 SECTOR_SIZE = 2048
@@ -16,6 +22,42 @@ HEADER_MAGIC = b"MICROSOFT*XBOX*MEDIA"
 XBE_HEADER = b'XBEH'
 XBE_CERT_ADDRESS_OFFSET = 280
 XBE_CERT_LENGTH = 492
+PADDING_BYTE = b'\xFF'
+# smaller extents are copied, as a separate write would cost more
+SENDFILE_MIN_SIZE = 64 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class FileExtent:
+    """
+    A byte range of unpatched file data that can be sent as is from the
+    underlying file (i.e. with sendfile) instead of being read in Python.
+    The file is the subfile name, or None for the image itself.
+    """
+    __slots__ = ("reader", "file", "offset", "length")
+
+    def __init__(self, reader, file, offset, length):
+        self.reader = reader
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def send(self, sock):
+        self.reader.sendfile(sock, self.file, self.offset, self.length)
+
+    def split(self, size):
+        """
+        Returns the extent as a list of extents of at most size bytes
+        """
+        return [FileExtent(self.reader, self.file, self.offset + i,
+                           min(size, self.length - i))
+                for i in range(0, self.length, size)]
+
+    def read(self):
+        if self.file is None:
+            return self.reader.read_at(self.offset, self.length)
+        return self.reader.read_subfile_at(self.file, self.offset,
+                                           self.length)
 
 
 class ImageParser(ABC):
@@ -34,28 +76,109 @@ class ImageParser(ABC):
         self.patcher = None
         self.filesize = 0
         self.toc = None
-        self.avl_tree = None
+        self.index = None
+        self.title_id = None
         self.patches = None
+        self.readahead = None
+        self.block_cache = None
+        self.image_id = None
         self.valid = self.test_file()
 
     def parse(self, patches):
         self.f.open()
         self.patcher = Patcher(self)
+        self.readahead = self.create_readahead()
+        if self.args.block_cache_size > 0:
+            self.block_cache = get_block_cache(self.args.block_cache_size *
+                                               1024 * 1024)
+            if self.image_id is not None:
+                # parsed again (e.g. with other patches)
+                self.block_cache.invalidate(self.image_id)
+            self.image_id = get_image_id()
         self.filesize = self.f.get_size()
+        cache = None
+        if not self.args.no_cache:
+            cache = get_disk_cache(self.args.cache_dir, "toc")
+            cache_key = get_cache_key(type(self).__name__,
+                                      type(self.f).__name__,
+                                      self.get_identity(), patches,
+                                      self.args.apply_media_patch)
+            state = cache.load(cache_key)
+            if state is not None:
+                self.set_state(state)
+                if self.verbose:
+                    print("loaded TOC from cache: " + self.f.filepath)
+                self.f.close()
+                return
         self.get_toc()
         if self.verbose:
             print(json.dumps(self.toc, indent=4))
-        self.avl_tree = AVLTree(self.toc)
-        title_id, _ = self.get_xbe_info()
+        self.index = IntervalIndex(self.toc)
+        self.title_id, _ = self.get_xbe_info()
         if self.requires_media_patch() or self.args.apply_media_patch:
             xbes = fnmatch.filter(self.toc.keys(), "FILE:*.xbe")
-            media_patches = self.patcher.get_media_patches(title_id, xbes)
-            patches.extend(media_patches)
-        self.patches = self.patcher.parse_patches(patches, title_id)
+            media_patches = self.patcher.get_media_patches(self.title_id,
+                                                           xbes)
+            patches = patches + media_patches
+        self.patches = self.patcher.parse_patches(patches, self.title_id)
+        if cache is not None:
+            cache.store(cache_key, self.get_state())
         self.f.close()
 
+    def create_readahead(self):
+        """
+        Returns the Readahead for the image, None if disabled (with
+        --readahead auto, it's enabled for the readers where reading is slow)
+        """
+        mode = self.args.readahead
+        if mode == "off" or (mode == "auto" and
+                             not self.f.readahead_default):
+            return None
+        return Readahead(self, self.args.readahead_cache_size * 1024 * 1024)
+
+    def get_identity(self):
+        """
+        Returns data identifying the current version of the input
+        (e.g. path, size and modification time), for the TOC cache.
+        """
+        return self.f.get_identity()
+
+    def get_state(self):
+        """
+        Returns the parsing results (TOC, index, title ID and patches),
+        using only types supported by the TOC cache.
+        """
+        return {
+            "toc": self.toc,
+            "index": self.index.get_state(),
+            "title_id": self.title_id,
+            "patches": {f: p.get_state() for f, p in self.patches.items()},
+            "filesize": self.filesize
+        }
+
+    def set_state(self, state):
+        self.toc = state["toc"]
+        self.index = IntervalIndex.from_state(state["index"])
+        self.title_id = state["title_id"]
+        self.patches = {f: PatchOverlay.from_state(p)
+                        for f, p in state["patches"].items()}
+        self.filesize = state["filesize"]
+
     def close(self):
-        self.f.close()
+        # called after each request, but the reader is shared by all the
+        # requests for this image (possibly concurrent), so it's kept open
+        pass
+
+    def close_forced(self):
+        """
+        Releases the reader and the cached data of the image, when the
+        parser is not used anymore
+        """
+        if self.readahead is not None:
+            self.readahead.close()
+        if self.block_cache is not None:
+            self.block_cache.invalidate(self.image_id)
+        self.f.close_forced()
 
     def get_xbe_info(self):
         xbe = "default.xbe"
@@ -79,22 +202,130 @@ class ImageParser(ABC):
     def get_data_in_range(self, start, end):
         """
         Returns the data in XISO format for the specified byte range.
+        The output is allocated once (prefilled with the padding byte) and
+        each node is written in place at its position in the range.
         """
-        nodes = self.avl_tree.get_nodes_in_range(start, end)
+        nodes = self.lookup_nodes(start, end)
         if self.verbose:
             print(json.dumps({"start": start, "end": end}, indent=4))
-            print(json.dumps(nodes, indent=4))
-        data = bytes(0)
+            print(json.dumps([n.to_dict() for n in nodes], indent=4))
+        return self.assemble_nodes(nodes, start, end)
+
+    def iter_segments_in_range(self, start, end):
+        """
+        Yields the data in XISO format for the specified byte range as
+        segments, in order. Each segment is either a buffer (possibly a
+        memoryview of the source file or of a prefetched block) of at most
+        STREAM_CHUNK_SIZE bytes, or a FileExtent for unpatched file data
+        that the reader can send directly. The data is only read when the
+        segment is reached, so the memory use doesn't depend on the size of
+        the range.
+        """
+        if self.readahead is not None:
+            self.readahead.on_request(start, end)
+        if self.block_cache is not None:
+            return self.block_cache.iter_segments_in_range(self, self.image_id,
+                                                           start, end)
+        return self.iter_uncached_segments_in_range(start, end)
+
+    def iter_uncached_segments_in_range(self, start, end):
+        """
+        Like iter_segments_in_range, without the blocks of the block cache
+        """
+        if self.readahead is not None:
+            return self.readahead.iter_segments_in_range(start, end)
+        return self.iter_source_segments_in_range(start, end)
+
+    def iter_source_segments_in_range(self, start, end):
+        """
+        Like iter_segments_in_range, without any cached or prefetched block
+        """
+        nodes = self.lookup_nodes(start, end)
+        if self.verbose:
+            print(json.dumps({"start": start, "end": end}, indent=4))
+            print(json.dumps([n.to_dict() for n in nodes], indent=4))
+        pos = start
+        if self.f.sendfile_enabled or self.f.views_enabled:
+            # end of the previous nodes (the entries can share data)
+            covered = start
+            for i, node in enumerate(nodes):
+                node_start = node.offset + node.start
+                node_end = node.offset + node.end
+                # the nodes are sorted, only the next one can start inside
+                overlapped = node_start < covered or (
+                    i + 1 < len(nodes) and
+                    nodes[i + 1].offset + nodes[i + 1].start < node_end)
+                covered = max(covered, node_end)
+                if node.file == PAD_NODE or overlapped:
+                    # overlapping nodes are assembled below, in TOC order
+                    continue
+                extent = self.get_direct_extent(node)
+                if extent is None:
+                    continue
+                yield from self.iter_data_in_range(pos, node_start)
+                yield extent
+                pos = node_end
+        yield from self.iter_data_in_range(pos, end)
+
+    def iter_data_in_range(self, start, end):
+        """
+        Yields the data in XISO format for the specified byte range as
+        buffers of at most STREAM_CHUNK_SIZE bytes
+        """
+        for chunk_start in range(start, end, STREAM_CHUNK_SIZE):
+            chunk_end = min(end, chunk_start + STREAM_CHUNK_SIZE)
+            yield self.assemble_range(chunk_start, chunk_end)
+
+    def assemble_range(self, start, end):
+        nodes = self.lookup_nodes(start, end)
+        return self.assemble_nodes(nodes, start, end)
+
+    def assemble_nodes(self, nodes, start, end):
+        data = bytearray(PADDING_BYTE) * (end - start)
+        view = memoryview(data)
         for node in nodes:
-            data += self.get_node_data_in_range(node)
+            self.write_node_data_in_range(node, view, start)
         return data
 
+    def get_direct_extent(self, node):
+        """
+        Returns a memoryview (if the reader maps the files) or a FileExtent
+        for the node if its data can be sent directly (file data not touched
+        by patches, large enough), None otherwise.
+        """
+        length = node.end - node.start
+        if length < SENDFILE_MIN_SIZE:
+            return None
+        node_type, filename = node.file.split(":", 1)
+        if node_type != "FILE":
+            return None
+        patch = self.patches.get(filename)
+        if patch is not None and patch.overlaps(node.start, node.end):
+            return None
+        extent = self.get_file_extent(node)
+        if extent is None:
+            return None
+        if self.f.views_enabled:
+            view = self.f.get_view(extent.file, extent.offset, extent.length)
+            if view is not None:
+                return view
+        if not self.f.can_sendfile(extent.file):
+            return None
+        return extent
+
+    def lookup_nodes(self, start, end):
+        # timed as the TOC lookup stage of the requests
+        t = time.perf_counter()
+        nodes = self.index.get_nodes_in_range(start, end)
+        stage_timer.add("toc", t)
+        return nodes
+
     def get_files_in_range(self, start, end):
         """
         Returns the files and TOC entries within the specified byte range.
         The byte range for each entry is included.
         """
-        return self.avl_tree.get_nodes_in_range(start, end)
+        return self.index.get_nodes_in_range(start, end)
 
     def add_file_to_toc(self, file_path, data_offset, node_size):
         self.toc["FILE:" + file_path[1:]] = {
@@ -133,34 +364,38 @@ class ImageParser(ABC):
         if self.args.verbose:
             print("found header")
 
-    def get_node_data_in_range(self, node):
+    def write_node_data_in_range(self, node, view, start):
         """
-        Returns the data in XISO format for the specified file and byte range.
+        Writes the data in XISO format for the specified node into the output
+        view of a range beginning at start.
         Applies patches to the file if needed.
+        Padding is not written, the output is expected to be prefilled.
         """
-        node_type = node["file"].split(":")[0]
-        filename = node["file"].split(":")[1]
-        s = node["start"]
-        e = node["end"]
+        if node.file == PAD_NODE:
+            return
+        node_type, filename = node.file.split(":", 1)
+        s = node.start
+        e = node.end
+        pos = node.offset + s - start
+        buf = view[pos:pos + e - s]
         if node_type == "HEADER":
-            data = self.get_header_data_in_range(node)
+            buf[:] = self.get_header_data_in_range(node)
         elif node_type == "TOC":
-            data = self.get_toc_data_in_range(node)
+            buf[:] = self.get_toc_data_in_range(node)
         elif node_type == "FILE":
-            data = self.get_file_data_in_range(node)
+            t = time.perf_counter()
+            self.read_file_data_in_range(node, buf)
+            stage_timer.add("read", t)
             if filename in self.patches:
+                t = time.perf_counter()
                 patch = self.patches[filename]
-                data = self.patcher.apply_patch(patch, data, s)
-        else:
-            data = self.get_empty_data_in_range(s, e)
-        start_padding = self.get_empty_data_in_range(0, node["start_padding"])
-        end_padding = self.get_empty_data_in_range(0, node["end_padding"])
-        return start_padding + data + end_padding
+                self.patcher.apply_patch(patch, buf, s)
+                stage_timer.add("patch", t)
 
     def get_header_data_in_range(self, node):
-        start = node["start"]
-        end = node["end"]
-        key = node["file"]
+        start = node.start
+        end = node.end
+        key = node.file
         toc = self.toc[key]
         offset = self.f.uint32_bytes(toc["extra"]["root_offset"])
         size = self.f.uint32_bytes(toc["extra"]["root_size"])
@@ -171,9 +406,9 @@ class ImageParser(ABC):
         return full_data[start:end]
 
     def get_toc_data_in_range(self, node):
-        start = node["start"]
-        end = node["end"]
-        key = node["file"]
+        start = node.start
+        end = node.end
+        key = node.file
         toc = self.toc[key]
         name = key.split(":")[1].split("/")[-1]
         d = toc["extra"]
@@ -184,18 +419,26 @@ class ImageParser(ABC):
         attr = bytes([d["attributes"]])
         namelen = bytes([len(name)])
         full_data = l + r + sec + siz + attr + namelen + name.encode('ascii')
-        padding_size = node["size"] - len(full_data)
+        padding_size = node.size - len(full_data)
         full_data += self.get_empty_data_in_range(0, padding_size)
         return full_data[start:end]
 
     def get_empty_data_in_range(self, start, end):
-        return bytes([0xFF for i in range(end - start)])
+        return PADDING_BYTE * (end - start)
 
     @abstractmethod
-    def get_file_data_in_range(self, node):
+    def read_file_data_in_range(self, node, buf):
+        """
+        Reads the data of the specified file in the input byte range
+        into buf (a writable memoryview of the same length).
+        """
+
+    def get_file_extent(self, node):
         """
-        Returns the data of the specified file in the input byte range.
+        Returns a FileExtent for the file data of the node in its byte range,
+        or None if the data has to be read.
         """
+        return None
 
     @abstractmethod
     def get_file_data(self, filename, start, length):
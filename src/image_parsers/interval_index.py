@@ -0,0 +1,106 @@
+"""
+Immutable interval index for byte range search over the table of contents
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+PAD_NODE = "PAD:PAD"
+
+
+class RangeNode:
+    """
+    A TOC entry (or a gap between entries, with file PAD:PAD) within a
+    searched byte range:
+    - file: the TOC key
+    - offset: the entry offset in the image
+    - size: the entry size
+    - start, end: the byte range within the entry
+    """
+    __slots__ = ("file", "offset", "size", "start", "end")
+
+    def __init__(self, file, offset, size, start, end):
+        self.file = file
+        self.offset = offset
+        self.size = size
+        self.start = start
+        self.end = end
+
+    def to_dict(self):
+        return {
+            "file": self.file,
+            "offset": self.offset,
+            "size": self.size,
+            "start": self.start,
+            "end": self.end
+        }
+
+
+class IntervalIndex:
+    """
+    Sorted interval index over entries with an "offset" and a "size".
+    The entries are stored in parallel arrays sorted by offset, and searched
+    with bisect in O(log n + k) for k entries in the range.
+    The index is not modified after creation.
+    """
+
+    def __init__(self, entries):
+        items = sorted((e["offset"], e["size"], k) for k, e in entries.items())
+        self.offsets = array('Q', (i[0] for i in items))
+        self.sizes = array('Q', (i[1] for i in items))
+        self.names = [i[2] for i in items]
+        # running maximum of the entry ends, so that the search also works
+        # with entries sharing data (e.g. deduplicated files)
+        self.max_ends = array('Q')
+        max_end = 0
+        for offset, size, _ in items:
+            max_end = max(max_end, offset + size)
+            self.max_ends.append(max_end)
+
+    def get_state(self):
+        return (self.offsets.tobytes(), self.sizes.tobytes(),
+                self.max_ends.tobytes(), self.names)
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Recreates an index from the output of get_state
+        """
+        index = cls({})
+        index.offsets.frombytes(state[0])
+        index.sizes.frombytes(state[1])
+        index.max_ends.frombytes(state[2])
+        index.names = list(state[3])
+        return index
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_nodes_in_range(self, start, end):
+        """
+        Retrieves the entries overlapping a byte range (delimited by start and
+        end) in order, as RangeNode objects, with a PAD:PAD node for each gap.
+        """
+        offsets = self.offsets
+        sizes = self.sizes
+        names = self.names
+        res = []
+        pos = start
+        i = bisect_right(self.max_ends, start)
+        j = bisect_left(offsets, end)
+        for k in range(i, j):
+            offset = offsets[k]
+            size = sizes[k]
+            if offset + size <= start or size == 0:
+                continue
+            if offset > pos:
+                res.append(RangeNode(PAD_NODE, pos, offset - pos, 0,
+                                     offset - pos))
+            res.append(RangeNode(names[k], offset, size,
+                                 max(0, start - offset),
+                                 min(size, end - offset)))
+            pos = max(pos, offset + size)
+        if pos < end:
+            res.append(RangeNode(PAD_NODE, pos, end - pos, 0, end - pos))
+        return res
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+import threading
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache of buffers, bounded by the
+    total size (in bytes) of the stored values.
+    Keeps hit, miss and eviction counters.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, value):
+        """
+        Stores the value, evicting the least recently used entries if the
+        cache is full. Returns the evicted (key, value) pairs.
+        """
+        evicted = []
+        size = len(value)
+        if size > self.max_size:
+            return evicted
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                old_key, old_value = self.entries.popitem(last=False)
+                self.size -= len(old_value)
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+        return evicted
+
+    def remove(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+    def remove_if(self, condition):
+        """
+        Removes all the entries whose key satisfies the condition
+        """
+        with self.lock:
+            keys = [k for k in self.entries if condition(k)]
+            for key in keys:
+                self.size -= len(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0
+            }
@@ -14,7 +14,7 @@ class OtherFormatsParser(ImageParser):
     The base class handles generation of the XISO table of contents.
     Subclasses have to implement the following methods:
     - get_files
-    - get_file_data_in_range
+    - read_file_data_in_range
     - get_file_data
     - test_file
     """
@@ -31,6 +31,17 @@ class OtherFormatsParser(ImageParser):
     def get_size(self):
         return self.dirsize
 
+    def get_state(self):
+        state = super().get_state()
+        state["root_size"] = self.root_size
+        state["dirsize"] = self.dirsize
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.root_size = state["root_size"]
+        self.dirsize = state["dirsize"]
+
     def get_toc(self):
         files = self.get_toc_data()
         self.toc = {}
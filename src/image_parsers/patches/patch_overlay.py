@@ -0,0 +1,97 @@
+from bisect import bisect_right
+import heapq
+
+
+class PatchOverlay:
+    """
+    The patched bytes of a file, as sorted non-overlapping extents.
+    Compiled once from address-based patch operations (where operations
+    overlap, the later one wins), then spliced into data chunks.
+    """
+
+    def __init__(self, operations=None):
+        self.addresses = []
+        self.ends = []
+        self.data = []
+        if operations:
+            self.compile(operations)
+
+    def compile(self, operations):
+        """
+        Merges the operations (dictionaries with "address" and hex
+        "patched_data") into non-overlapping extents.
+        """
+        ops = []
+        for operation in operations:
+            pdata = bytes.fromhex(operation["patched_data"])
+            if len(pdata) > 0:
+                addr = operation["address"]
+                ops.append((addr, addr + len(pdata), pdata))
+
+        # sweep over the operation boundaries, keeping the active operations
+        # in a heap with the latest one on top
+        points = sorted(set([op[0] for op in ops] + [op[1] for op in ops]))
+        starts = sorted(range(len(ops)), key=lambda k: ops[k][0])
+        active = []
+        j = 0
+        for i in range(len(points) - 1):
+            p = points[i]
+            while j < len(starts) and ops[starts[j]][0] == p:
+                k = starts[j]
+                heapq.heappush(active, (-k, ops[k][1]))
+                j += 1
+            while active and active[0][1] <= p:
+                heapq.heappop(active)
+            if not active:
+                continue
+            k = -active[0][0]
+            addr, _, pdata = ops[k]
+            chunk = pdata[p - addr:points[i + 1] - addr]
+            if self.ends and self.ends[-1] == p:
+                self.data[-1] += chunk
+                self.ends[-1] = points[i + 1]
+            else:
+                self.addresses.append(p)
+                self.ends.append(points[i + 1])
+                self.data.append(bytearray(chunk))
+        self.data = [bytes(d) for d in self.data]
+
+    def get_overlapping(self, start, end):
+        """
+        Returns the index range of the extents overlapping start..end
+        """
+        i = bisect_right(self.ends, start)
+        j = i
+        while j < len(self.addresses) and self.addresses[j] < end:
+            j += 1
+        return i, j
+
+    def overlaps(self, start, end):
+        i, j = self.get_overlapping(start, end)
+        return i < j
+
+    def apply(self, buf, start):
+        """
+        Applies the patch in place to the data chunk buf (a writable
+        memoryview or bytearray starting at the file offset start).
+        """
+        end = start + len(buf)
+        i, j = self.get_overlapping(start, end)
+        for k in range(i, j):
+            addr = self.addresses[k]
+            s = max(addr, start)
+            e = min(self.ends[k], end)
+            buf[s - start:e - start] = self.data[k][s - addr:e - addr]
+
+    def get_state(self):
+        return (self.addresses, self.data)
+
+    @classmethod
+    def from_state(cls, state):
+        overlay = cls()
+        overlay.addresses = list(state[0])
+        overlay.data = list(state[1])
+        overlay.ends = [a + len(d) for a, d in zip(overlay.addresses,
+                                                   overlay.data)]
+        return overlay
+
@@ -1,5 +1,9 @@
+import hashlib
 import json
 
+from ..disk_cache import get_cache_key, get_disk_cache
+from .patch_overlay import PatchOverlay
+
 
 class Patcher():
     """
@@ -8,6 +12,7 @@ class Patcher():
 
     def __init__(self, parser):
         self.parser = parser
+        self.file_hashes = {}
 
     def get_media_patches(self, title_id, xbes):
         res = []
@@ -33,10 +38,13 @@ class Patcher():
         """
         Merges the input patches to have only one address-based patch
         for each file, discarding patches made for other title_ids.
+        Each file patch is compiled into a PatchOverlay.
         """
         res = {}
         for patch in patches:
-            p_title_id = patch["title_id"].lower()
+            p_title_id = patch["title_id"]
+            if p_title_id is not None:
+                p_title_id = p_title_id.lower()
             if p_title_id != title_id and p_title_id is not None:
                 continue
             if p_title_id is None:
@@ -52,79 +60,135 @@ class Patcher():
                 print("applying patch: " + json.dumps(new_operations,
                                                       indent=4))
                 res[f].extend(new_operations)
-        return res
+        return {f: PatchOverlay(op) for f, op in res.items()}
 
     def preprocess_patch(self, file, operations):
+        """
+        Outputs the data addresses for the input patch operations.
+        The results are cached on disk by file content and operations,
+        so they're shared by all the images with the same file.
+        """
+        args = self.parser.args
+        searched = [op for op in operations if "address" not in op]
+        if args.no_cache or len(searched) == 0:
+            return self.resolve_patch(file, operations)
+        cache = get_disk_cache(args.cache_dir, "patch_addresses")
+        key = get_cache_key(self.get_file_hash(file), operations)
+        res = cache.load(key)
+        if res is None:
+            res = self.resolve_patch(file, operations)
+            cache.store(key, res)
+        return res
+
+    def get_file_hash(self, file):
+        """
+        Returns the SHA-256 of the content of the specified file
+        """
+        if file not in self.file_hashes:
+            filesize = self.parser.toc["FILE:" + file]["size"]
+            chunk_size = 1024*1024
+            h = hashlib.sha256()
+            cur_chunk_addr = 0
+            while cur_chunk_addr < filesize:
+                length = min(chunk_size, filesize - cur_chunk_addr)
+                h.update(self.parser.get_file_data(file, cur_chunk_addr,
+                                                   length))
+                cur_chunk_addr += length
+            self.file_hashes[file] = h.hexdigest()
+        return self.file_hashes[file]
+
+    def resolve_patch(self, file, operations):
         """
         Outputs the data addresses for the input patch operations.
         If the input patch only has the original data, it finds the address.
+        All the addresses are found with a single pass over the file.
         """
-        res = []
+        # occurrence (counting repeated consecutive patterns) of the data of
+        # each find-replace operation
+        occurrences = []
+        needed = {}
         prev_data = None
         count = 0
         for operation in operations:
             if "address" in operation and "patched_data" in operation:
-                res.append(operation)
+                occurrences.append(None)
             elif "original_data" in operation and "patched_data" in operation:
                 og_data = operation["original_data"]
                 if og_data == prev_data:
                     count += 1
                 else:
                     count = 0
-                address = self.get_data_address(file, og_data, count)
-                if address >= 0:
+                data = bytes.fromhex(og_data)
+                occurrences.append((data, count))
+                needed[data] = max(needed.get(data, 0), count + 1)
+                prev_data = og_data
+            else:
+                occurrences.append(None)
+
+        found = self.get_data_addresses(file, needed)
+
+        res = []
+        for operation, occurrence in zip(operations, occurrences):
+            if "address" in operation and "patched_data" in operation:
+                res.append(operation)
+            elif occurrence is not None:
+                data, count = occurrence
+                if count < len(found[data]):
                     new_operation = {
-                        "address": address,
+                        "address": found[data][count],
                         "patched_data": operation["patched_data"]
                     }
                     res.append(new_operation)
                 else:
                     print("Failed to apply patch: " + json.dumps(operation,
                                                                  indent=4))
-                prev_data = operation["original_data"]
             else:
                 print("Cannot apply patch: " + json.dumps(operation, indent=4))
         return res
 
-    def apply_patch(self, patch, data, start):
+    def apply_patch(self, patch, buf, start):
         """
-        Applies a patch to the specified data chunk.
+        Applies a patch (a PatchOverlay) in place to the specified data chunk
+        (a writable memoryview or bytearray starting at the file offset start).
         Supports partial overlap between the patch and the chunk.
         """
-        data_chunk = list(data)
-        for operation in patch:
-            pdata = bytes.fromhex(operation["patched_data"])
-            plen = len(pdata)
-            addr = operation["address"]
-            for i in range(plen):
-                j = addr + i - start
-                if j >= 0 and j < len(data_chunk):
-                    data_chunk[j] = pdata[i]
-        return bytes(data_chunk)
+        patch.apply(buf, start)
 
-    def get_data_address(self, file, data_str, count):
+    def get_data_addresses(self, file, needed):
         """
-        Finds the data addrses of the specified data (input as hex string)
-        in the specified file. The file is read in 1 MiB chunks.
+        Finds the addresses of the specified data in the specified file, with
+        a single pass over the file, read in 1 MiB chunks.
+        needed is a dictionary with the data (bytes) as key and the number of
+        non-overlapping occurrences to find as value.
+        Returns a dictionary with the data as key and the list of occurrence
+        addresses (possibly shorter than needed) as value.
         """
-        # TODO: find all required addresses in one run instead of N runs
+        found = {data: [] for data in needed}
+        pending = set(data for data, n in needed.items() if n > 0)
+        if len(pending) == 0:
+            return found
         filesize = self.parser.toc["FILE:" + file]["size"]
         chunk_size = 1024*1024
+        # the end of the previous chunk is kept, to cover cases where the
+        # data would be across two chunks
+        overlap = max(len(data) for data in pending) - 1
+        next_addr = {data: 0 for data in pending}
+        tail = bytes(0)
         cur_chunk_addr = 0
-        data = bytes.fromhex(data_str)
-        addr = -1
-        while addr < 0 and cur_chunk_addr < filesize:
-            chunk = self.parser.get_file_data(file, cur_chunk_addr, chunk_size)
-            addr = chunk.find(data)
-            if addr >= 0:
-                addr += cur_chunk_addr
-            if addr >= 0 and count > 0:
-                # resume searching from the current address
-                cur_chunk_addr = addr + len(data)
-                addr = -1
-                count -= 1
-            else:
-                # go to the next chunk, but make it overlap
-                # to cover cases where the data would be across two chunks
-                cur_chunk_addr += chunk_size - len(data)
-        return addr
+        while len(pending) > 0 and cur_chunk_addr < filesize:
+            length = min(chunk_size, filesize - cur_chunk_addr)
+            read = self.parser.get_file_data(file, cur_chunk_addr, length)
+            chunk = tail + read
+            base = cur_chunk_addr - len(tail)
+            for data in list(pending):
+                addr = chunk.find(data, max(0, next_addr[data] - base))
+                while addr >= 0:
+                    found[data].append(base + addr)
+                    next_addr[data] = base + addr + len(data)
+                    if len(found[data]) == needed[data]:
+                        pending.remove(data)
+                        break
+                    addr = chunk.find(data, addr + len(data))
+            tail = chunk[max(0, len(chunk) - overlap):]
+            cur_chunk_addr += length
+        return found
@@ -0,0 +1,160 @@
+import queue
+import threading
+
+from .block_cache import iter_cached_segments
+from .lru_cache import LRUCache
+
+
+BLOCK_SIZE = 256 * 1024
+MIN_WINDOW = 2 # blocks
+STREAMS = 4
+PENDING_TIMEOUT = 10 # seconds
+
+
+class ReadaheadStream:
+    """
+    A sequential stream of range requests.
+    The generation is incremented when the stream is replaced,
+    to cancel its queued blocks.
+    """
+    __slots__ = ("last_end", "queued_until", "window", "generation")
+
+    def __init__(self):
+        self.last_end = -1
+        self.queued_until = 0
+        self.window = MIN_WINDOW
+        self.generation = 0
+
+
+class Readahead:
+    """
+    Detects the sequential streams of range requests on an image, and
+    assembles the following output blocks in advance on a background
+    thread, into a LRU cache (so the next request is a memory copy).
+    The window of a stream (blocks prefetched past its last request)
+    doubles each time the stream continues, up to max_window, and the
+    queued blocks of a stream are cancelled when a seek replaces it.
+    """
+
+    def __init__(self, parser, cache_size):
+        self.parser = parser
+        self.cache = LRUCache(cache_size)
+        # leave room in the cache for the windows of all the streams
+        self.max_window = max(MIN_WINDOW, cache_size // BLOCK_SIZE // STREAMS)
+        self.lock = threading.Lock()
+        self.streams = []
+        self.pending = {}
+        self.queue = queue.Queue()
+        self.thread = None
+        self.prefetched = 0
+        self.cancelled = 0
+
+    def on_request(self, start, end):
+        """
+        Queues the blocks following the request if it continues one of the
+        recent streams, otherwise replaces the least recently used stream
+        """
+        with self.lock:
+            stream = None
+            for s in self.streams:
+                if s.last_end - BLOCK_SIZE <= start <= s.last_end + BLOCK_SIZE:
+                    stream = s
+                    break
+            if stream is None:
+                if len(self.streams) >= STREAMS:
+                    stream = self.streams.pop(0)
+                    stream.generation += 1
+                    stream.window = MIN_WINDOW
+                else:
+                    stream = ReadaheadStream()
+                stream.last_end = end
+                stream.queued_until = (end - 1) // BLOCK_SIZE + 1
+                self.streams.append(stream)
+                return
+            self.streams.remove(stream)
+            self.streams.append(stream)
+            stream.last_end = end
+            stream.window = min(self.max_window, stream.window * 2)
+            block_count = (self.parser.get_size() - 1) // BLOCK_SIZE + 1
+            next_block = (end - 1) // BLOCK_SIZE + 1
+            first = max(next_block, stream.queued_until)
+            last = min(next_block + stream.window, block_count)
+            stream.queued_until = max(stream.queued_until, last)
+            generation = stream.generation
+            if self.thread is None and first < last:
+                self.thread = threading.Thread(target=self.worker,
+                                               daemon=True)
+                self.thread.start()
+        for index in range(first, last):
+            self.queue.put((stream, generation, index))
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            stream, generation, index = item
+            if stream.generation != generation:
+                self.cancelled += 1
+                continue
+            with self.lock:
+                if index in self.pending or index in self.cache:
+                    continue
+                event = threading.Event()
+                self.pending[index] = event
+            try:
+                start = index * BLOCK_SIZE
+                end = min(start + BLOCK_SIZE, self.parser.get_size())
+                data = self.parser.assemble_range(start, end)
+                self.cache.put(index, bytes(data))
+                self.prefetched += 1
+            except Exception as e:
+                print("Readahead failed: " + str(e))
+            finally:
+                with self.lock:
+                    del self.pending[index]
+                event.set()
+
+    def get_block(self, index):
+        """
+        Returns the prefetched block (waiting for it if it's being
+        assembled), None if not prefetched
+        """
+        with self.lock:
+            event = self.pending.get(index)
+        if event is not None:
+            event.wait(PENDING_TIMEOUT)
+        return self.cache.get(index)
+
+    def iter_segments_in_range(self, start, end):
+        """
+        Like ImageParser.iter_segments_in_range, with the prefetched blocks
+        served from memory
+        """
+        return iter_cached_segments(start, end, BLOCK_SIZE, self.get_block,
+                                    self.parser.iter_source_segments_in_range)
+
+    def close(self):
+        """
+        Cancels the queued blocks and waits for the background thread to
+        stop (it skips them before reaching the end marker), so the reader
+        can be closed
+        """
+        with self.lock:
+            for stream in self.streams:
+                stream.generation += 1
+            self.streams = []
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+        self.cache.clear()
+
+    def get_stats(self):
+        stats = self.cache.get_stats()
+        stats["prefetched"] = self.prefetched
+        stats["cancelled"] = self.cancelled
+        with self.lock:
+            stats["windows"] = [s.window for s in self.streams]
+        return stats
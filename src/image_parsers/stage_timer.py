@@ -0,0 +1,39 @@
+import threading
+import time
+
+
+# TOC lookup, reader I/O, patch application and socket write
+STAGES = ("toc", "read", "patch", "write")
+
+local = threading.local()
+
+
+def start(times=None):
+    """
+    Starts accumulating the time spent in each stage by the current thread,
+    into times if specified (so a request handled by several threads has a
+    single total), returns the accumulator
+    """
+    if times is None:
+        times = dict.fromkeys(STAGES, 0.0)
+    local.times = times
+    return times
+
+
+def stop():
+    """
+    Stops accumulating on the current thread, returns the accumulator
+    """
+    times = getattr(local, "times", None)
+    local.times = None
+    return times
+
+
+def add(stage, start_time):
+    """
+    Adds the time elapsed since start_time (from time.perf_counter) to the
+    stage, if the current thread is accumulating
+    """
+    times = getattr(local, "times", None)
+    if times is not None:
+        times[stage] += time.perf_counter() - start_time
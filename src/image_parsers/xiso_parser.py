@@ -2,7 +2,8 @@
 # https://github.com/antangelo/xdvdfs
 # See Notice.txt for licensing information
 
-from .image_parser import ImageParser, HEADER_OFFSET, HEADER_MAGIC, SECTOR_SIZE
+from .image_parser import (ImageParser, FileExtent, HEADER_OFFSET,
+                           HEADER_MAGIC, SECTOR_SIZE)
 
 
 FULL_DUMP_DATA_OFFSET = 387 * 1024 * 1024
@@ -16,20 +17,31 @@ class XisoParser(ImageParser):
         self.image_start = None
         super().__init__(file_reader, args)
 
-    def get_file_data_in_range(self, node):
-        f = self.f
-        f.seek(self.image_start + node["offset"] + node["start"])
-        return f.read(node["end"] - node["start"])
+    def read_file_data_in_range(self, node, buf):
+        offset = self.image_start + node.offset + node.start
+        self.f.readinto_at(offset, buf)
+
+    def get_file_extent(self, node):
+        offset = self.image_start + node.offset + node.start
+        return FileExtent(self.f, None, offset, node.end - node.start)
 
     def get_file_data(self, filename, start, length):
-        f = self.f
         file = self.toc["FILE:" + filename]
-        f.seek(self.image_start + file["offset"] + start)
-        return f.read(length)
+        offset = self.image_start + file["offset"] + start
+        return self.f.read_at(offset, length)
 
     def get_size(self):
         return self.filesize - self.image_start
 
+    def get_state(self):
+        state = super().get_state()
+        state["image_start"] = self.image_start
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.image_start = state["image_start"]
+
     def requires_media_patch(self):
         return self.image_start > 0
 
@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+import urllib.parse
+
+
+IMAGE_EXTENSIONS = ('.iso', '.zip', '.chd')
+STATUS_PATH = "/__library"
+
+libraries = {}
+
+
+def find_images(root):
+    """
+    Returns the paths of the files under root that can be images: XISO, zip
+    and CHD files, and the default.xbe files of extracted directories
+    """
+    res = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            lower = name.lower()
+            if lower.endswith(IMAGE_EXTENSIONS) or lower == 'default.xbe':
+                res.append(os.path.join(dirpath, name))
+    return res
+
+
+def start_library(root, parser_cache, workers):
+    """
+    Starts loading the images under root, returns the Library
+    """
+    library = Library(root, parser_cache, workers)
+    libraries["default"] = library
+    library.start()
+    return library
+
+
+def get_library():
+    """
+    Returns the Library being served, None if not in library mode
+    """
+    return libraries.get("default")
+
+
+class LibraryImage:
+    """
+    The loading state of an image of the library
+    """
+    __slots__ = ("path", "state", "size", "seconds", "error")
+
+    def __init__(self, path):
+        self.path = path
+        self.state = "queued"
+        self.size = None
+        self.seconds = None
+        self.error = None
+
+
+class Library:
+    """
+    The images of a directory tree, parsed in advance (on a pool of a fixed
+    number of threads) through the parser cache, so the first request for
+    an image doesn't wait for its TOC.
+    The parsers beyond the cache size are closed again, but their TOCs are
+    in the persistent cache, so they are loaded quickly when requested.
+    """
+
+    def __init__(self, root, parser_cache, workers):
+        self.root = os.path.abspath(root)
+        self.parser_cache = parser_cache
+        self.workers = workers
+        self.images = []
+        self.lock = threading.Lock()
+        self.loaded = 0
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = time.time()
+        self.images = [LibraryImage(path) for path in find_images(self.root)]
+        print("Library: loading %d images from %s" % (len(self.images),
+                                                      self.root))
+        if len(self.images) > self.parser_cache.max_images:
+            print("Library: more images than --max_images, the least "
+                  "recently used are parsed again from the TOC cache")
+        if len(self.images) == 0:
+            self.finished = self.started
+            return
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        for image in self.images:
+            executor.submit(self.load, image)
+        executor.shutdown(wait=False)
+
+    def load(self, image):
+        try:
+            self.load_image(image)
+        finally:
+            with self.lock:
+                self.loaded += 1
+                if self.loaded == len(self.images):
+                    self.finished = time.time()
+                    print("Library: loaded in %.1fs" % (self.finished -
+                                                        self.started))
+
+    def load_image(self, image):
+        image.state = "parsing"
+        start = time.time()
+        try:
+            parser = self.parser_cache.acquire(image.path)
+        except Exception as e:
+            image.state = "failed"
+            image.error = str(e)
+            print("Library: unable to load %s: %s" % (image.path, e))
+            return
+        finally:
+            image.seconds = round(time.time() - start, 3)
+        if parser is None:
+            image.state = "unsupported"
+            return
+        try:
+            image.size = parser.get_size()
+        finally:
+            self.parser_cache.release(parser)
+        image.state = "ready"
+
+    def get_url(self, image):
+        relpath = os.path.relpath(image.path, self.root)
+        return "/" + urllib.parse.quote(relpath.replace(os.sep, '/'))
+
+    def get_status(self):
+        """
+        Returns the progress and the state of each image (JSON serializable)
+        """
+        images = []
+        counts = {}
+        for image in self.images:
+            counts[image.state] = counts.get(image.state, 0) + 1
+            images.append({
+                "url": self.get_url(image),
+                "state": image.state,
+                "size": image.size,
+                "seconds": image.seconds,
+                "error": image.error
+            })
+        with self.lock:
+            loaded = self.loaded
+            finished = self.finished
+        end = finished or time.time()
+        return {
+            "root": self.root,
+            "total": len(self.images),
+            "done": loaded,
+            "states": counts,
+            "loading": finished is None,
+            "seconds": round(end - self.started, 3),
+            "images": images
+        }
@@ -0,0 +1,199 @@
+from collections import deque
+import threading
+import time
+
+from image_parsers import stage_timer
+
+
+METRICS_PATH = "/__metrics"
+# upper bounds of the range size buckets (the last one is unbounded)
+RANGE_BUCKETS = [4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024,
+                 4 * 1024 * 1024, 16 * 1024 * 1024]
+# latencies kept for the percentiles of each stage
+LATENCY_SAMPLES = 4096
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def get_quantile(samples, q):
+    """
+    Returns the q quantile of the sorted samples (nearest rank)
+    """
+    if len(samples) == 0:
+        return 0.0
+    index = min(len(samples) - 1, int(q * len(samples)))
+    return samples[index]
+
+
+class RequestMetrics:
+    """
+    The measures of a request: the image (request path), the served ranges
+    as (first, last) pairs (None if no image data was served), the body
+    bytes sent and the time of each stage
+    """
+    __slots__ = ("image", "ranges", "sent", "times", "time", "start")
+
+    def __init__(self, image):
+        self.image = image
+        self.ranges = None
+        self.sent = 0
+        self.times = dict.fromkeys(stage_timer.STAGES, 0.0)
+        self.time = time.time()
+        self.start = time.perf_counter()
+
+
+class ImageMetrics:
+    """
+    Counters of the requests for an image
+    """
+    __slots__ = ("requests", "bytes", "range_counts", "range_bytes")
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.range_counts = [0] * (len(RANGE_BUCKETS) + 1)
+        self.range_bytes = 0
+
+    def add_range(self, size):
+        for i, bound in enumerate(RANGE_BUCKETS):
+            if size <= bound:
+                self.range_counts[i] += 1
+                break
+        else:
+            self.range_counts[-1] += 1
+        self.range_bytes += size
+
+
+class StageMetrics:
+    """
+    The latencies of a request stage: the last LATENCY_SAMPLES for the
+    percentiles, and the totals
+    """
+    __slots__ = ("samples", "count", "sum")
+
+    def __init__(self):
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self):
+        samples = sorted(self.samples)
+        res = {"count": self.count, "sum": self.sum}
+        for q in QUANTILES:
+            res["p%d" % round(q * 100)] = get_quantile(samples, q)
+        return res
+
+
+class Metrics:
+    """
+    Request metrics of the server: counts, bytes and range sizes by image,
+    and the latency of each stage (TOC lookup, reader I/O, patch
+    application, socket write, and the whole request).
+    The stage times of a request are accumulated with stage_timer.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images = {}
+        self.stages = {}
+
+    def record(self, request):
+        """
+        Records a finished request (only if it served image data)
+        """
+        if request.ranges is None:
+            return
+        total = time.perf_counter() - request.start
+        with self.lock:
+            metrics = self.images.get(request.image)
+            if metrics is None:
+                metrics = self.images[request.image] = ImageMetrics()
+            metrics.requests += 1
+            metrics.bytes += request.sent
+            for first, last in request.ranges:
+                metrics.add_range(last - first + 1)
+            times = list(request.times.items()) + [("total", total)]
+            for stage, seconds in times:
+                if stage not in self.stages:
+                    self.stages[stage] = StageMetrics()
+                self.stages[stage].add(seconds)
+
+    def get_data(self, caches):
+        """
+        Returns the metrics and the stats of the caches (by name), JSON
+        serializable
+        """
+        with self.lock:
+            images = {}
+            for image, m in self.images.items():
+                images[image] = {
+                    "requests": m.requests,
+                    "bytes": m.bytes,
+                    "range_sizes": {
+                        "buckets": RANGE_BUCKETS + ["+Inf"],
+                        "counts": list(m.range_counts),
+                        "sum": m.range_bytes
+                    }
+                }
+            stages = {name: s.to_dict() for name, s in self.stages.items()}
+        return {"images": images, "stages": stages, "caches": caches}
+
+
+def escape_label(value):
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+
+def format_prometheus(data):
+    """
+    Returns the output of Metrics.get_data in the Prometheus text format
+    """
+    lines = []
+
+    def add(name, kind, samples):
+        lines.append("# TYPE %s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            label_text = ",".join('%s="%s"' % (k, escape_label(str(v)))
+                                  for k, v in labels)
+            lines.append("%s%s{%s} %s" % (name, suffix, label_text,
+                                          repr(float(value))))
+
+    images = data["images"]
+    add("xiso_requests_total", "counter",
+        [("", [("image", i)], m["requests"]) for i, m in images.items()])
+    add("xiso_sent_bytes_total", "counter",
+        [("", [("image", i)], m["bytes"]) for i, m in images.items()])
+    samples = []
+    for image, m in images.items():
+        ranges = m["range_sizes"]
+        cumulative = 0
+        for bound, count in zip(ranges["buckets"], ranges["counts"]):
+            cumulative += count
+            samples.append(("_bucket", [("image", image), ("le", bound)],
+                            cumulative))
+        samples.append(("_sum", [("image", image)], ranges["sum"]))
+        samples.append(("_count", [("image", image)], cumulative))
+    add("xiso_range_size_bytes", "histogram", samples)
+    samples = []
+    for stage, s in data["stages"].items():
+        for q in QUANTILES:
+            samples.append(("", [("stage", stage), ("quantile", q)],
+                            s["p%d" % round(q * 100)]))
+        samples.append(("_sum", [("stage", stage)], s["sum"]))
+        samples.append(("_count", [("stage", stage)], s["count"]))
+    add("xiso_stage_seconds", "summary", samples)
+    # one gauge for each numeric stat of the caches
+    stats = {}
+    for cache, values in data["caches"].items():
+        for key, value in values.items():
+            if isinstance(value, (int, float)) and \
+               not isinstance(value, bool):
+                stats.setdefault(key, []).append(("", [("cache", cache)],
+                                                  value))
+    for key, samples in sorted(stats.items()):
+        add("xiso_cache_" + key, "gauge", samples)
+    return "\n".join(lines) + "\n"
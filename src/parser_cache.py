@@ -0,0 +1,168 @@
+from collections import OrderedDict
+import os
+import threading
+
+
+class ParserEntry:
+    """
+    A cached parser, with the stat of its file when it was created
+    """
+    __slots__ = ("parser", "stat", "ready", "refcount", "removed")
+
+    def __init__(self, stat):
+        self.parser = None
+        self.stat = stat
+        self.ready = threading.Event()
+        self.refcount = 0
+        self.removed = False
+
+
+class ParserCache:
+    """
+    Thread-safe cache of the parsers of the served images.
+    - Each parser is created once (the requests arriving while it's being
+      created wait for it instead of creating their own)
+    - At most max_images parsers are kept, the least recently used are
+      removed and closed (after their last request has ended)
+    - A parser is replaced when the size or the modification time of its
+      file change
+    Parsers are used between acquire and release.
+    """
+
+    def __init__(self, factory, max_images):
+        self.factory = factory
+        self.max_images = max_images
+        self.entries = OrderedDict()
+        self.acquired = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_stat(self, path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns)
+
+    def acquire(self, path):
+        """
+        Returns the parser for the file (creating it if needed), None if
+        not found or unsupported. Must be followed by release(parser).
+        """
+        if not os.path.isfile(path):
+            return None
+        stat = self.get_stat(path)
+        to_close = []
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.ready.is_set() and \
+               entry.stat != stat:
+                self.invalidations += 1
+                to_close += self.remove(path)
+                entry = None
+            create = entry is None
+            if create:
+                entry = ParserEntry(stat)
+                self.entries[path] = entry
+                self.misses += 1
+            else:
+                self.entries.move_to_end(path)
+                self.hits += 1
+            entry.refcount += 1
+        self.close_parsers(to_close)
+        if create:
+            try:
+                entry.parser = self.factory(path)
+            except Exception:
+                # not cached, the next request tries again
+                with self.lock:
+                    if self.entries.get(path) is entry:
+                        del self.entries[path]
+                raise
+            finally:
+                entry.ready.set()
+            self.evict()
+        else:
+            entry.ready.wait()
+        if entry.parser is None:
+            # unsupported files are cached too (as None)
+            self.release_entry(entry)
+            return None
+        with self.lock:
+            self.acquired[id(entry.parser)] = entry
+        return entry.parser
+
+    def release(self, parser):
+        with self.lock:
+            entry = self.acquired.get(id(parser))
+        if entry is not None:
+            self.release_entry(entry)
+
+    def release_entry(self, entry):
+        to_close = []
+        with self.lock:
+            entry.refcount -= 1
+            if entry.refcount == 0 and entry.parser is not None:
+                self.acquired.pop(id(entry.parser), None)
+                if entry.removed:
+                    to_close.append(entry.parser)
+        self.close_parsers(to_close)
+
+    def remove(self, path):
+        """
+        Removes an entry (with the lock held), returns the parsers that can
+        be closed right away (the others are closed on release)
+        """
+        entry = self.entries.pop(path)
+        entry.removed = True
+        if entry.refcount == 0 and entry.parser is not None:
+            return [entry.parser]
+        return []
+
+    def evict(self):
+        to_close = []
+        with self.lock:
+            for path in list(self.entries.keys()):
+                if len(self.entries) <= self.max_images:
+                    break
+                if self.entries[path].ready.is_set():
+                    to_close += self.remove(path)
+                    self.evictions += 1
+        self.close_parsers(to_close)
+
+    def close_parsers(self, parsers):
+        for parser in parsers:
+            try:
+                parser.close_forced()
+            except Exception as e:
+                print("Unable to close parser: " + str(e))
+
+    def clear(self):
+        to_close = []
+        with self.lock:
+            for path in list(self.entries.keys()):
+                if self.entries[path].ready.is_set():
+                    to_close += self.remove(path)
+        self.close_parsers(to_close)
+
+    def get_parsers(self):
+        """
+        Returns the cached parsers by path
+        """
+        with self.lock:
+            return {path: entry.parser for path, entry in self.entries.items()
+                    if entry.parser is not None}
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "images": len(self.entries),
+                "max_images": self.max_images,
+                "in_use": len(self.acquired),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0
+            }
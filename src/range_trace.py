@@ -0,0 +1,99 @@
+import atexit
+import struct
+import threading
+
+
+TRACE_MAGIC = b"XISOTRC1"
+# record types: the name of an image (first use), a served range
+IMAGE_RECORD = 0
+RANGE_RECORD = 1
+# type, image id, name length (followed by the name in UTF-8)
+IMAGE_STRUCT = struct.Struct("<BHH")
+# type, image id, timestamp, start, end (exclusive), latency in seconds
+RANGE_STRUCT = struct.Struct("<BHdQQf")
+
+traces = {}
+
+
+def start_trace(path):
+    """
+    Starts recording the served ranges into path (closed on exit), returns
+    the TraceWriter
+    """
+    trace = TraceWriter(path)
+    traces["default"] = trace
+    atexit.register(trace.close)
+    return trace
+
+
+def get_trace():
+    """
+    Returns the TraceWriter of the server, None if not recording
+    """
+    return traces.get("default")
+
+
+class TraceWriter:
+    """
+    Records the served ranges into a compact binary file: a header, then
+    one fixed size record per range (the images are numbered, each name is
+    written once, before its first range).
+    Thread-safe, each record is flushed (so the trace of a running or
+    killed server can be read).
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(TRACE_MAGIC)
+        self.lock = threading.Lock()
+        self.image_ids = {}
+
+    def write(self, timestamp, image, start, end, latency):
+        with self.lock:
+            if self.f is None:
+                return
+            image_id = self.image_ids.get(image)
+            if image_id is None:
+                image_id = len(self.image_ids)
+                self.image_ids[image] = image_id
+                name = image.encode('utf-8')
+                self.f.write(IMAGE_STRUCT.pack(IMAGE_RECORD, image_id,
+                                               len(name)) + name)
+            self.f.write(RANGE_STRUCT.pack(RANGE_RECORD, image_id, timestamp,
+                                           start, end, latency))
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+def read_trace(path):
+    """
+    Yields the ranges of a trace as (timestamp, image, start, end, latency)
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError("Not a trace file: " + path)
+        images = {}
+        while True:
+            kind = f.read(1)
+            if len(kind) == 0:
+                return
+            if kind[0] == IMAGE_RECORD:
+                data = kind + f.read(IMAGE_STRUCT.size - 1)
+                if len(data) < IMAGE_STRUCT.size:
+                    return # truncated (e.g. the server was killed)
+                _, image_id, length = IMAGE_STRUCT.unpack(data)
+                images[image_id] = f.read(length).decode('utf-8')
+            elif kind[0] == RANGE_RECORD:
+                data = kind + f.read(RANGE_STRUCT.size - 1)
+                if len(data) < RANGE_STRUCT.size:
+                    return
+                _, image_id, timestamp, start, end, latency = \
+                    RANGE_STRUCT.unpack(data)
+                yield timestamp, images[image_id], start, end, latency
+            else:
+                raise ValueError("Invalid record in trace file: " + path)
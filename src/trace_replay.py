@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Replays a trace recorded with --trace_file, through the image parsers
+(ImageParser.get_data_in_range) or through a running server (HTTP range
+requests), at the original pace or as fast as possible, and reports the
+throughput and the latency percentiles.
+The server arguments (e.g. --patches, --mmap, the cache sizes) configure
+the parsers in parser mode.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import os
+import threading
+import time
+import urllib.parse
+
+from argument_parser import get_arg_parser, set_args
+from metrics import get_quantile, QUANTILES
+from range_trace import read_trace
+
+
+def get_args():
+    parser = get_arg_parser()
+    parser.add_argument("trace", help="the trace file to replay")
+    parser.add_argument("--mode", help="replay through the parsers or a running server (default parser)",
+                        choices=["parser", "http"], default="parser")
+    parser.add_argument("--speed", help="replay at the recorded pace or as fast as possible (default max)",
+                        choices=["original", "max"], default="max")
+    parser.add_argument("--root", help="directory of the images in parser mode (default working directory)",
+                        default=os.getcwd())
+    parser.add_argument("--host", help="server address in http mode (default 127.0.0.1, the port is --port)",
+                        default="127.0.0.1")
+    parser.add_argument("--concurrency", help="requests replayed at the same time (default 4)",
+                        type=int, default=4)
+    return parser.parse_args()
+
+
+class ParserTarget:
+    """
+    Replays the ranges on the image parsers (created before the replay)
+    """
+
+    def __init__(self, root, images):
+        # imported here, the module reads the arguments on import
+        from xiso_request_handler import get_new_parser_for_file
+        self.parsers = {}
+        for image in images:
+            # the names in the trace are already unquoted
+            path = image.lstrip('/')
+            parser = get_new_parser_for_file(os.path.join(root, path))
+            if parser is None:
+                raise ValueError("Unable to open image: " + image)
+            parser.f.open()
+            self.parsers[image] = parser
+
+    def replay(self, image, start, end):
+        return len(self.parsers[image].get_data_in_range(start, end))
+
+
+class HttpTarget:
+    """
+    Replays the ranges as requests to a server (a connection per thread)
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.local = threading.local()
+
+    def replay(self, image, start, end):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host,
+                                                                self.port)
+        conn.request('GET', urllib.parse.quote(image),
+                     headers={'Range': 'bytes=%d-%d' % (start, end - 1)})
+        response = conn.getresponse()
+        data = response.read()
+        if response.status not in (200, 206):
+            raise ValueError("HTTP %d for %s" % (response.status, image))
+        return len(data)
+
+
+def replay(target, records, speed, concurrency):
+    """
+    Returns the bytes read, the elapsed time and the latencies
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def run(image, start, end):
+        t = time.perf_counter()
+        n = target.replay(image, start, end)
+        latency = time.perf_counter() - t
+        with lock:
+            latencies.append(latency)
+        return n
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    futures = []
+    begin = time.perf_counter()
+    first_timestamp = records[0][0]
+    for timestamp, image, start, end, _ in records:
+        if speed == "original":
+            delay = timestamp - first_timestamp - (time.perf_counter() - begin)
+            if delay > 0:
+                time.sleep(delay)
+        futures.append(executor.submit(run, image, start, end))
+    total = sum(future.result() for future in futures)
+    elapsed = time.perf_counter() - begin
+    executor.shutdown()
+    return total, elapsed, latencies
+
+
+def print_report(label, total, elapsed, latencies):
+    latencies = sorted(latencies)
+    print("%s: %d ranges, %.1f MiB in %.2fs (%.1f MiB/s)" % (
+        label, len(latencies), total / (1024 * 1024), elapsed,
+        total / elapsed / (1024 * 1024)))
+    print("latency: " + ", ".join(
+        "p%d %.2f ms" % (round(q * 100), get_quantile(latencies, q) * 1000)
+        for q in QUANTILES) + ", max %.2f ms" % (latencies[-1] * 1000))
+
+
+if __name__ == "__main__":
+    args = get_args()
+    set_args(args)
+    records = list(read_trace(args.trace))
+    if len(records) == 0:
+        print("The trace is empty")
+    else:
+        recorded = sorted(r[4] for r in records)
+        print_report("recorded", sum(r[3] - r[2] for r in records),
+                     records[-1][0] - records[0][0] + recorded[-1], recorded)
+        if args.mode == "parser":
+            target = ParserTarget(args.root, set(r[1] for r in records))
+        else:
+            target = HttpTarget(args.host, args.port)
+        total, elapsed, latencies = replay(target, records, args.speed,
+                                           args.concurrency)
+        print_report("replayed (%s, %s speed)" % (args.mode, args.speed),
+                     total, elapsed, latencies)
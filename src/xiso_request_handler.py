@@ -3,41 +3,110 @@
 
 from http import HTTPStatus
 from http.server import SimpleHTTPRequestHandler
+import json
 import os
 import re
 import time
+import urllib.parse
+import uuid
 
 from argument_parser import get_args
+from image_parsers import stage_timer
+from image_parsers.block_cache import get_block_cache
 from image_parsers.directory_parser import DirectoryParser
+from image_parsers.disk_cache import get_disk_cache
+from image_parsers.image_parser import FileExtent
+from image_parsers.file_readers.fd_pool import get_fd_pool
 from image_parsers.file_readers.file_reader import FileReader
+from image_parsers.file_readers.mmap_reader import MmapFileReader
 from image_parsers.file_readers.zip_reader import ZipReader
 from image_parsers.file_readers.chd_reader import ChdReader, CHD_ENABLED
 from image_parsers.patches.patch_parser import PatchParser
 from image_parsers.xiso_parser import XisoParser
+from library import get_library, STATUS_PATH as LIBRARY_STATUS_PATH
+from metrics import (format_prometheus, Metrics, METRICS_PATH,
+                     RequestMetrics)
+from parser_cache import ParserCache
+from range_trace import get_trace
 
 
-BYTE_RANGE_RE = re.compile(r'bytes=(\d+)-(\d+)?$')
+BYTE_RANGE_RE = re.compile(r'\s*(\d*)\s*-\s*(\d*)\s*$')
+MAX_RANGES = 100
 def parse_byte_range(byte_range):
-    """Returns the two numbers in 'bytes=123-456' or throws ValueError.
+    """Returns the ranges in 'bytes=0-99,200-,-50' as a list of
+    (first, last) pairs or throws ValueError.
 
-    The last number or both numbers may be None.
+    The last number may be None (up to the end of the file), the first
+    number is None for suffix ranges (the last N bytes of the file).
     """
-    if byte_range.strip() == '':
-        return None, None
-
-    m = BYTE_RANGE_RE.match(byte_range)
-    if not m:
+    unit, _, specs = byte_range.partition('=')
+    if unit.strip().lower() != 'bytes':
         raise ValueError('Invalid byte range %s' % byte_range)
 
-    first, last = [x and int(x) for x in m.groups()]
-    if last and last < first:
+    ranges = []
+    for spec in specs.split(','):
+        if spec.strip() == '':
+            continue
+        m = BYTE_RANGE_RE.match(spec)
+        if not m:
+            raise ValueError('Invalid byte range %s' % byte_range)
+        first, last = [int(x) if x else None for x in m.groups()]
+        if first is None and last is None:
+            raise ValueError('Invalid byte range %s' % byte_range)
+        if first is not None and last is not None and last < first:
+            raise ValueError('Invalid byte range %s' % byte_range)
+        ranges.append((first, last))
+    if len(ranges) == 0 or len(ranges) > MAX_RANGES:
         raise ValueError('Invalid byte range %s' % byte_range)
-    return first, last
+    return ranges
+
+
+def resolve_byte_ranges(ranges, file_len):
+    """
+    Returns the satisfiable ranges as (first, last) offsets in the file
+    (the other ones are left out)
+    """
+    res = []
+    for first, last in ranges:
+        if first is None:
+            if last == 0:
+                continue
+            first = max(0, file_len - last)
+            last = file_len - 1
+        elif first >= file_len:
+            continue
+        elif last is None or last >= file_len:
+            last = file_len - 1
+        res.append((first, last))
+    return res
+
+
+def get_response_parts(ranges, file_len, boundary):
+    """
+    Returns the parts of the response body as (header, first, last), and
+    the bytes that end the body.
+    A single range is sent as is, multiple ones as multipart/byteranges.
+    """
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        return [(b'', first, last)], b''
+    parts = []
+    for first, last in ranges:
+        header = ('\r\n--%s\r\n'
+                  'Content-Type: application/octet-stream\r\n'
+                  'Content-Range: bytes %d-%d/%d\r\n\r\n' % (
+                      boundary, first, last, file_len))
+        parts.append((header.encode('ascii'), first, last))
+    return parts, ('\r\n--%s--\r\n' % boundary).encode('ascii')
+
+
+def get_response_length(parts, end):
+    return sum(len(h) + last - first + 1 for h, first, last in parts) + \
+           len(end)
 
 
 args = get_args()
 patch_parser = PatchParser()
-xiso_cache = {}
 patches = []
 if args.patches is not None:
     for patch in args.patches:
@@ -50,29 +119,155 @@ if args.patches is not None:
 if not CHD_ENABLED:
     print("chd-rs-py not found, CHD support disabled")
 
+
+def get_new_parser_for_file(path):
+    chd_reader = ChdReader if CHD_ENABLED else None
+    file_reader = MmapFileReader if args.mmap else FileReader
+    for c in [
+        (XisoParser, file_reader), # XISO
+        (DirectoryParser, file_reader), # default.xbe
+        (XisoParser, ZipReader), # zipped XISO
+        (DirectoryParser, ZipReader), # zipped directory
+        (XisoParser, chd_reader), # CHD compressed XISO (experimental)
+    ]:
+        if c[1] is None:
+            continue
+        f = c[1](path, args)
+        parser = c[0](f, args)
+        if parser.valid:
+            parser.parse(patches)
+            return parser
+    print("Unsupported file format in file: " + path)
+    return None
+
+
+parser_cache = ParserCache(get_new_parser_for_file, args.max_images)
+
+
+metrics = Metrics()
+
+
+def get_image_name(target):
+    """
+    Returns the name of the image of a request in the metrics (the path)
+    """
+    return urllib.parse.unquote(target.split('?', 1)[0].split('#', 1)[0])
+
+
+def finish_request(request):
+    """
+    Records a finished request (RequestMetrics) in the metrics and, if
+    enabled, in the trace
+    """
+    metrics.record(request)
+    trace = get_trace()
+    if trace is not None and request.ranges is not None:
+        latency = time.perf_counter() - request.start
+        for first, last in request.ranges:
+            trace.write(request.time, request.image, first, last + 1,
+                        latency)
+
+
+def get_cache_stats():
+    """
+    Returns the stats of the caches of the server and of the loaded images
+    """
+    caches = {
+        "parsers": parser_cache.get_stats(),
+        "fd_pool": get_fd_pool(args.fd_pool_size).get_stats()
+    }
+    if args.block_cache_size > 0:
+        block_cache = get_block_cache(args.block_cache_size * 1024 * 1024)
+        caches["blocks"] = block_cache.get_stats()
+    if not args.no_cache:
+        caches["toc"] = get_disk_cache(args.cache_dir, "toc").get_stats()
+        caches["patch_addresses"] = get_disk_cache(
+            args.cache_dir, "patch_addresses").get_stats()
+    cwd = os.getcwd()
+    for path, parser in parser_cache.get_parsers().items():
+        name = "/" + os.path.relpath(path, cwd).replace(os.sep, '/')
+        if parser.readahead is not None:
+            caches["readahead " + name] = parser.readahead.get_stats()
+        if hasattr(parser.f, 'get_stats'):
+            # decompressed data of zip and CHD files
+            caches["reader " + name] = parser.f.get_stats()
+    return caches
+
+
+def get_internal_page(target):
+    """
+    Returns the content type and the body of the pages of the server itself
+    (the metrics and the library status), None if target is not one of them
+    """
+    url = urllib.parse.urlsplit(target)
+    library = get_library()
+    if url.path == METRICS_PATH:
+        data = metrics.get_data(get_cache_stats())
+        query = urllib.parse.parse_qs(url.query)
+        if query.get('format') == ['prometheus']:
+            body = format_prometheus(data)
+            return 'text/plain; version=0.0.4', body.encode('utf-8')
+        body = json.dumps(data, indent=1) + "\n"
+        return 'application/json', body.encode('utf-8')
+    if url.path == LIBRARY_STATUS_PATH and library is not None:
+        body = json.dumps(library.get_status(), indent=1) + "\n"
+        return 'application/json', body.encode('utf-8')
+    return None
+
+
 class XisoRequestHandler(SimpleHTTPRequestHandler):
     """
     Extends SimpleHTTPRequestHandler with support for:
-    - Byte range requests
+    - Byte range requests (including suffix and multiple ranges)
     - Dynamic conversion of images to XISO format
     - Patch application on the fly
+    - Persistent connections (HTTP/1.1 keep-alive, closed after
+      --idle_timeout seconds without requests)
     """
+    protocol_version = "HTTP/1.1"
+    timeout = args.idle_timeout
+    # the headers and the body are sent separately, without this each
+    # response on a kept alive connection would wait for a delayed ACK
+    disable_nagle_algorithm = True
+    xiso_parser = None
+
+    def do_GET(self):
+        self.serve_request(SimpleHTTPRequestHandler.do_GET)
+
+    def do_HEAD(self):
+        self.serve_request(SimpleHTTPRequestHandler.do_HEAD)
+
+    def serve_request(self, method):
+        self.request_metrics = RequestMetrics(get_image_name(self.path))
+        stage_timer.start(self.request_metrics.times)
+        try:
+            method(self)
+        finally:
+            stage_timer.stop()
+            finish_request(self.request_metrics)
+            self.release_parser()
+
+    def release_parser(self):
+        if self.xiso_parser is not None:
+            parser_cache.release(self.xiso_parser)
+            self.xiso_parser = None
 
     def send_head(self):
-        self.patches = patches
+        page = get_internal_page(self.path)
+        if page is not None:
+            self.send_internal_page(*page)
+            return None
+
         path = self.translate_path(self.path)
-        self.xiso_parser = self.get_parser_for_file(path)
+        self.xiso_parser = parser_cache.acquire(path)
         ranged = 'Range' in self.headers
 
         if ranged:
             try:
-                self.range = parse_byte_range(self.headers['Range'])
+                ranges = parse_byte_range(self.headers['Range'])
             except ValueError:
                 self.send_error(400, 'Invalid byte range')
                 return None
-            first, last = self.range
-        else:
-            self.range = None
 
         if self.xiso_parser is None:
             self.send_error(404, 'File not found')
@@ -83,75 +278,70 @@ class XisoRequestHandler(SimpleHTTPRequestHandler):
         file_len = self.xiso_parser.get_size()
 
         self.file_len = file_len
+        content_type = 'application/octet-stream'
         if ranged:
-            if first >= file_len:
+            ranges = resolve_byte_ranges(ranges, file_len)
+            if len(ranges) == 0:
                 self.send_error(416, 'Requested Range Not Satisfiable')
                 return None
             self.send_response(206)
-            if last is None or last >= file_len:
-                last = file_len - 1
-            response_length = last - first + 1
-            self.send_header('Content-Range',
-                             'bytes %s-%s/%s' % (first, last, file_len))
-            content_length = response_length
+            boundary = uuid.uuid4().hex
+            self.parts, self.parts_end = get_response_parts(ranges, file_len,
+                                                            boundary)
+            if len(ranges) == 1:
+                first, last = ranges[0]
+                self.send_header('Content-Range',
+                                 'bytes %s-%s/%s' % (first, last, file_len))
+            else:
+                content_type = 'multipart/byteranges; boundary=' + boundary
         else:
             self.send_response(HTTPStatus.OK)
-            content_length = file_len
+            self.parts = [(b'', 0, file_len - 1)]
+            self.parts_end = b''
+        content_length = get_response_length(self.parts, self.parts_end)
+        if self.command == 'GET':
+            # HEAD responses have no body, they're not served ranges
+            self.request_metrics.ranges = [(first, last) for _, first, last
+                                           in self.parts]
 
-        self.send_header('Content-type', 'application/octet-stream')
+        self.send_header('Content-type', content_type)
         self.send_header('Content-Length', str(content_length))
         self.send_header('Last-Modified', self.date_time_string(time.time()))
         self.end_headers()
 
         return self.xiso_parser
 
-    def get_parser_for_file(self, path):
-        if not os.path.isfile(path):
-            return None
-        if path not in xiso_cache:
-            xiso_cache[path] = self.get_new_parser_for_file(path)
-        return xiso_cache[path]
-
-    def get_new_parser_for_file(self, path):
-        chd_reader = ChdReader if CHD_ENABLED else None
-        for c in [
-            (XisoParser, FileReader), # XISO
-            (DirectoryParser, FileReader), # default.xbe
-            #(XisoParser, ZipReader), # zipped XISO (disabled, seek too slow)
-            (DirectoryParser, ZipReader), # zipped directory (experimental)
-            (XisoParser, chd_reader), # CHD compressed XISO (experimental)
-        ]:
-            if c[1] is None:
-                continue
-            f = c[1](path)
-            parser = c[0](f, args)
-            if parser.valid:
-                parser.parse(self.patches)
-                return parser
-        print("Unsupported file format in file: " + path)
-        return None
+    def send_internal_page(self, content_type, body):
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
 
     def end_headers(self):
         self.send_header('Accept-Ranges', 'bytes')
         return SimpleHTTPRequestHandler.end_headers(self)
 
     def copyfile(self, source, outputfile):
-        buf_size = 1024*1024
-        if self.range:
-            # A chunk of the file was requested
-            start, stop = self.range
-            buf = source.get_data_in_range(start, stop + 1)
-            outputfile.write(buf)
+        # the segments are produced while sending, in bounded chunks
+        for header, first, last in self.parts:
+            if len(header) > 0:
+                outputfile.write(header)
+            for segment in source.iter_segments_in_range(first, last + 1):
+                self.write_segment(segment, outputfile)
+        if len(self.parts_end) > 0:
+            outputfile.write(self.parts_end)
+
+    def write_segment(self, segment, outputfile):
+        t = time.perf_counter()
+        if isinstance(segment, FileExtent):
+            # unpatched file data, sent by the kernel from the source file
+            outputfile.flush()
+            segment.send(self.connection)
+            self.request_metrics.sent += segment.length
         else:
-            # The entire file was requested
-            # (for testing only, not for use with xemu)
-            # FIXME: the downloaded file sometimes is missing the last MiB or so
-            start = 0
-            stop = buf_size
-            true_stop = self.file_len + 1
-            while stop < true_stop:
-                buf = source.get_data_in_range(start, stop)
-                outputfile.write(buf)
-                start += buf_size
-                stop += buf_size
-                stop = min(true_stop, stop)
+            outputfile.write(segment)
+            self.request_metrics.sent += len(segment)
+        stage_timer.add("write", t)